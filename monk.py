@@ -1,6 +1,24 @@
 #!/usr/bin/env python
 from __future__ import print_function
-import re, os, sys, argparse, string, glob, copy, shlex
+import re, os, sys, argparse, string, glob, copy, shlex, hashlib
+import multiprocessing, heapq, time, errno, subprocess, json, array, fnmatch
+import select, filecmp, socket, shutil, fcntl, hmac, tempfile, gc, textwrap
+import resource
+try:
+    from shlex import quote as shellQuote
+except ImportError:
+    from pipes import quote as shellQuote
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 
 longhelp = """
 makemake [--command [FLAG COMMAND_WORD]* ]* --files [FILENAME]*
@@ -113,6 +131,9 @@ class _AttributeHolder(object):
 
 class Word(_AttributeHolder):
     """A component of a rule, has a pattern and a number of flags."""
+    flags = ("match", "input", "output", "once", "listing", "phony",
+             "mkdir", "intermediate", "invisible", "tagged")
+
     def __init__(self, pattern = "", pattern__ = None, match = False,
                  input = False, output = False, listing = False, once = False,
                  phony = False, intermediate = False, invisible = False,
@@ -131,47 +152,79 @@ class Word(_AttributeHolder):
         self.tagged      = tagged
 
 class UnmatchedWord(Word):
-    def tryMatch(self, filename):
-        """return a matched word, or None"""
+    boundClass = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("boundClass", None)
+        return state
+
+    def bound(self):
+        """The class of the words this one becomes in matched commands."""
+        if self.boundClass is None:
+            base = SubstitutedWord
+            if self.match:
+                base = MatchedWord
+            attrs = dict([(f, getattr(self, f)) for f in ("pattern",) + Word.flags])
+            attrs["template"] = self
+            attrs["__slots__"] = ()
+            self.boundClass = type(base.__name__, (base,), attrs)
+        return self.boundClass
+
+    def regexp(self):
+        if self.pattern__ is None:
+            self.pattern__ = re.compile(self.pattern)
+        return self.pattern__
+
+    def matchGroups(self, filename):
+        """return the groups matched in the filename, or None"""
         if self.match:
-            if self.pattern__ is None:
-                self.pattern__ = re.compile(self.pattern)
-            match = re.match(self.pattern__, filename)
+            match = self.regexp().match(filename)
             if match:
-                return MatchedWord(self, rematch=match)
+                return match.groups()
 
-    def subst(self, matched):
+    def tryMatch(self, filename):
+        """return a matched word, or None"""
+        groups = self.matchGroups(filename)
+        if groups is not None:
+            return self.bound()(filename)
+
+    def subst(self, groups):
         """Uses a string to format the matched groups"""
         if self.match:
             raise Exception("Can't have a second matching argument "
                             "({0}) in a command".format(self.pattern))
-        return SubstitutedWord(self, rematch=matched.rematch)
-
-class MatchedWord(Word):
-    def __init__(self, copyfrom, rematch):
-        """Initialize from a template word and a regex match"""
-        self.rematch = rematch
-        self.word = rematch.string
-        super(MatchedWord,self).__init__(**(copyfrom.__dict__))
-        if type(self.word) is not str:
-            print("oops!")
-            pass
+        return self.bound()(self.pattern.format(*groups))
 
-    def groups(self):
-        return self.rematch.groups()
+class BoundWord(object):
+    """A word of a matched command: the string a template word became.
+    Each template word makes its own subclass, holding its pattern and
+    flags as class attributes, so they are stored once per template yet
+    read as quickly as if each word had its own."""
+    __slots__ = ("word",)
+    template = None
 
-    def __setattr__(self, attr, value):
-        if attr == "word" and type(value) is not str:
-            print("oops!")
-            pass
-        super(MatchedWord, self).__setattr__(attr, value)
+    def __init__(self, word):
+        self.word = word
+
+    def __reduce__(self):
+        #the subclasses are made on the fly, so pickle the template instead.
+        return (bindWord, (self.template, self.word))
 
+    def __repr__(self):
+        return "{0}({1!r}, {2!r})".format(type(self).__name__,
+                                          self.pattern, self.word)
+
+class MatchedWord(BoundWord):
+    """The word that matched a file."""
+    __slots__ = ()
 
-class SubstitutedWord(Word):
-    def __init__(self, copyfrom, rematch):
-        """Initialize from a matched word and a substitution"""
-        self.word = copyfrom.pattern.format(*(rematch.groups()))
-        super(SubstitutedWord,self).__init__(**(copyfrom.__dict__))
+class SubstitutedWord(BoundWord):
+    """A word formatted from the groups of a match."""
+    __slots__ = ()
+
+def bindWord(template, word):
+    return template.bound()(word)
 
 class Command(_AttributeHolder):
     def __init__(self, words=None):
@@ -180,293 +233,3612 @@ class Command(_AttributeHolder):
         else:
             self.words = []
         self.matchCount = 0
+        self.matcher = None
+        #up to how many matches to run in one invocation (see BatchCommand).
+        self.batch = None
+        #the name of the pool that limits how many of its rules run at once.
+        self.pool = None
 
-    def tryMatch(self,filename):
-        #check for exactly one matcher
-        if len([i for i in self.words if i.match]) != 1:
+    def matchWord(self):
+        """The single --match word of this command."""
+        matchers = [i for i in self.words if i.match]
+        if len(matchers) != 1:
             raise Exception("Must have exactly one --match argument, in command {0}"
                             .format(self.description()))
-        matches = [i.tryMatch(filename) for i in self.words]
-        theMatch = [i for i in matches if i is not None]
-        if len(theMatch) <= 0:
-            return None
-        theMatch = theMatch[0]
-        matchedWords = [match if match is not None else word.subst(theMatch)
-                        for (match, word) in zip(matches, self.words)]
-        self.matchCount = self.matchCount + 1
+        return matchers[0]
+
+    def matchGroups(self, filename):
+        """Return the groups our --match word finds in the filename, or
+        None."""
+        return self.words[self.matcherPosition()].matchGroups(filename)
+
+    def matcherPosition(self):
+        #the position of the matcher is checked once, on first use.
+        if self.matcher is None:
+            self.matcher = self.words.index(self.matchWord())
+        return self.matcher
+
+    def build(self, filename, groups):
+        """Make the matched command for a filename and the groups matched
+        in it."""
+        matcher = self.matcherPosition()
+        matchedWords = [word.bound()(filename) if n == matcher
+                        else word.subst(groups)
+                        for (n, word) in enumerate(self.words)]
         return MatchedCommand(words=matchedWords)
 
+    def match(self, filename):
+        """Return a matched command, or None."""
+        groups = self.matchGroups(filename)
+        if groups is None:
+            return None
+        return self.build(filename, groups)
+
+    def tryMatch(self,filename):
+        """Return a matched command, or None, counting successful matches."""
+        matched = self.match(filename)
+        if matched is not None:
+            self.matchCount = self.matchCount + 1
+        return matched
+
     def description(self):
         return " ".join([i.pattern for i in self.words])
 
-def getList(listfile):
-    if os.access(listfile, os.F_OK):
+def wordProducts(words):
+    listed = [i
+              for word in words
+              if word.output and word.listing
+              for i in getList(word.word)]
+    return listed + [word.word for word in words if word.output]
+
+def wordDependencies(words):
+    listed = [i
+              for word in words
+              if word.input and word.listing
+              for i in getList(word.word)]
+    return listed + [word.word for word in words if word.input]
+
+class ListingCache(object):
+    """Remembers the contents of listing files for the duration of a run,
+    so that a listing is only read again if its modification time or size
+    changes. Contents are shared between callers as tuples."""
+    def __init__(self):
+        self.entries = {}
+        self.reads = 0
+        self.hits = 0
+
+    def get(self, listfile):
+        try:
+            st = os.stat(listfile)
+        except OSError:
+            return ()
+        key = (st.st_mtime, st.st_size)
+        entry = self.entries.get(listfile)
+        if entry is not None and entry[0] == key:
+            self.hits = self.hits + 1
+            return entry[1]
         with file(listfile, 'r') as f:
-            return [i.strip() for i in f.readlines()]
-    else:
-        return []
+            contents = tuple([i.strip() for i in f.readlines()])
+        self.reads = self.reads + 1
+        self.entries[listfile] = (key, contents)
+        return contents
+
+    def stats(self):
+        return ("listings: {0} read from {1} files, {2} reads avoided"
+                .format(self.reads, len(self.entries), self.hits))
+
+listingCache = ListingCache()
+
+def getList(listfile):
+    return listingCache.get(listfile)
 
 class MatchedCommand(Command):
+    def __init__(self, words=None, sources=()):
+        super(MatchedCommand, self).__init__(words)
+        #(command index, filename) for each match folded into this command.
+        self.sources = list(sources)
+        #the first word seen with each string, once merging has begun.
+        self.wordsSeen = None
+        #set for multiple outputs; words share their flags, so aren't marked.
+        self.tagged = False
+
     def setTagged(self):
         outputs = [word for word in self.words if word.output]
         listings = [word for word in outputs if word.listing]
         if len(outputs) > 1 or len(listings) > 0:
-            for output in outputs:
-                output.tagged = True
+            self.tagged = True
 
     def products(self):
-        listed = [i
-                  for word in self.words
-                  if word.output and word.listing
-                  for i in getList(word.word)]
-        return listed + [word.word for word in self.words if word.output]
-
-    def taggedProducts(self, tagdir):
-        if self.isTagged():
-            #replicating the the first output will suffice.
-            firstOutput = [word for word in self.words if word.output][0]
-            return [os.path.join(tagdir, firstOutput.word)]
-        else:
-            return self.products()
+        return wordProducts(self.words)
 
     def dependencies(self):
-        listed = [i
-                  for word in self.words
-                  if word.input and word.listing
-                  for i in getList(word.word)]
-        return listed + [word.word for word in self.words if word.input]
-
-    def taggedDependencies(self, rules_dict, tagdir):
-        return [self.tagIfTagged(x, rules_dict, tagdir) for x in self.dependencies()]
-
-    def tagIfTagged(self, dep, rules_dict, tagdir):
-        #look up a file and check if it needs to be a tagged file
-        if rules_dict.has_key(dep) and rules_dict[dep].isTagged():
-            rule = rules_dict[dep]
-            firstOutput = [word for word in rule.words if word.output][0]
-            return os.path.join(tagdir, firstOutput.word)
-        else:
-            return dep
+        return wordDependencies(self.words)
 
     def merge(self, *others):
+        """Append the words of other commands to this one, returning the
+        words that were added."""
         ##add the words in order. If "once" is used, the first word
         ##determines the flags.  And "once" must be marked on the
         ##first word
-        wordsSeen = {}
-        words = []
-        for word in sum([x.words for x in [self] + list(others)], []):
-            if not (wordsSeen.has_key(word.word) and wordsSeen[word.word].once):
-                words.append(word)
-                if not wordsSeen.has_key(word.word):
-                    wordsSeen[word.word] = word
-        self.words = words
+        if self.wordsSeen is None:
+            #the first merge also applies "once" among our own words.
+            self.wordsSeen = {}
+            words = self.words
+            self.words = []
+            self.appendWords(words)
+        added = []
+        for x in others:
+            added.extend(self.appendWords(x.words))
+            self.sources.extend(x.sources)
+        return added
+
+    def appendWords(self, words):
+        added = []
+        for word in words:
+            seen = self.wordsSeen.get(word.word)
+            if seen is None:
+                self.wordsSeen[word.word] = word
+            elif seen.once:
+                continue
+            self.words.append(word)
+            added.append(word)
+        return added
 
     def isTagged(self):
-        return any([word.tagged for word in self.words if word.output])
+        return self.tagged or any([word.tagged for word in self.words if word.output])
+
+    def commandLine(self):
+        return " ".join([i.word for   i  in self.words if not i.invisible])
+
+def distinct(seq):
+    """Order preserving removal of duplicate strings."""
+    seen = set()
+    result = []
+    for item in seq:
+        if item not in seen:
+            seen.add(item)
+            result.append(item)
+    return result
+
+def unique(seq, idfun=id):
+    # order preserving prune of a list by object identity
+    seen = {}
+    result = []
+    for item in seq:
+        marker = idfun(item)
+        if marker in seen: continue
+        seen[marker] = 1
+        result.append(item)
+    return result
+
+_metachars = frozenset(".^$*+?{}[]\\|()")
+_quantifiers = frozenset("*+?{")
+_inlineFlags = re.compile(r"\(\?[aiLmsux-]")
+_backreference = re.compile(r"\\[1-9]|\(\?P=")
 
-    def touchedfiles(self, tagdir):
-        return " ".join(set(self.taggedProducts(tagdir)))
+def _escaped(pattern, i):
+    """True if the character at position i is preceded by an odd number of
+    backslashes."""
+    n = 0
+    while i - n > 0 and pattern[i - n - 1] == "\\":
+        n = n + 1
+    return n % 2 == 1
 
-    def touchPre(self, tagdir):
-        if self.isTagged():
-            return ("\ttouch {0}".format(self.touchedfiles(tagdir)) +
-                    ("\n" if self.commandLine() else "")
-                    )
+def _topLevelAlternation(pattern):
+    """True if the pattern has a '|' outside of any group."""
+    depth = 0
+    inClass = False
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == "\\":
+            i = i + 2
+            continue
+        if inClass:
+            if c == "]":
+                inClass = False
+        elif c == "[":
+            inClass = True
+            #a ']' just after the opening bracket is a literal.
+            if pattern[i+1:i+2] == "^":
+                i = i + 1
+            if pattern[i+1:i+2] == "]":
+                i = i + 1
+        elif c == "(":
+            depth = depth + 1
+        elif c == ")":
+            depth = depth - 1
+        elif c == "|" and depth == 0:
+            return True
+        i = i + 1
+    return False
+
+def _hasClass(pattern):
+    """True if the pattern has a character class, whose ']' may be
+    escaped inside it."""
+    return bool([i for (i, c) in enumerate(pattern)
+                 if c == "[" and not _escaped(pattern, i)])
+
+def _literalsUnreliable(pattern):
+    return bool(_inlineFlags.search(pattern)) or _topLevelAlternation(pattern)
+
+def literalPrefix(pattern):
+    """The literal text that every string matched by the pattern (with
+    re.match) must begin with. Errs on the side of returning too little."""
+    if _literalsUnreliable(pattern):
+        return ""
+    chars = []
+    i = 1 if pattern.startswith("^") else 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == "\\":
+            c = pattern[i+1:i+2]
+            if c == "" or c.isalnum():
+                #character classes, backreferences and the like.
+                break
+            width = 2
+        elif c in _metachars:
+            break
         else:
-            return ""
+            width = 1
+        if pattern[i+width:i+width+1] in _quantifiers:
+            #the character is optional or repeated.
+            break
+        chars.append(c)
+        i = i + width
+    return "".join(chars)
 
-    def touchPost(self, tagdir):
-        if self.isTagged():
-            return (" || ( rm {0} && false )".format(self.touchedfiles(tagdir))
-                    if self.commandLine() else "")
+def literalSuffix(pattern):
+    """The literal text that every string matched by the pattern must end
+    with (before an optional trailing newline). Only patterns anchored
+    with a final '$', and without character classes, have one."""
+    if (_literalsUnreliable(pattern) or not pattern.endswith("$")
+        or _escaped(pattern, len(pattern) - 1) or _hasClass(pattern)):
+        return ""
+    chars = []
+    i = len(pattern) - 1
+    while i > 0:
+        c = pattern[i-1]
+        if _escaped(pattern, i-1):
+            if c.isalnum():
+                break
+            chars.append(c)
+            i = i - 2
+        elif c in _metachars:
+            break
         else:
-            return ""
+            chars.append(c)
+            i = i - 1
+    chars.reverse()
+    return "".join(chars)
+
+class MatchIndex(object):
+    """Dispatches filenames to the commands whose --match pattern could
+    match them.
+
+    Commands are bucketed on the literal prefix and suffix of their
+    match pattern; buckets holding several commands are screened with
+    one combined alternation before the commands are tried one by one.
+    Candidates are returned in the order the commands were given, so
+    matching through the index gives the same results as trying every
+    command in turn."""
+    def __init__(self, commands):
+        self.commands = list(commands)
+        keyed = {}
+        for (position, command) in enumerate(self.commands):
+            pattern = command.matchWord().pattern
+            key = (literalPrefix(pattern), literalSuffix(pattern))
+            if _inlineFlags.search(pattern):
+                #its flags would apply to all of a combined prefilter.
+                key = key + (position,)
+            keyed.setdefault(key, []).append(position)
+        self.buckets = {}
+        for (key, positions) in sorted(keyed.items()):
+            self.buckets.setdefault(key[0], []).append(
+                (key[1], positions, self.prefilter(positions)))
+        self.prefixLengths = sorted(set([len(p) for p in self.buckets]))
 
-    def makeRule(self, rules_dict, tagdir, **kwargs):
-        return (
-            "{products}: {dependencies}\n"
-            "{mkdir_if_necessary}"
-            "{touch_preamble}"
-            "{command_indent}{command}{touch_postamble}\n"
-            "\n"
-            "{phony_rule}"
-            "{intermediate_rule}"
-            "{listing_rule}"
-            "{tagged_rule}"
-            ).format(**
-                { 'products'          : (
-                         " ".join(set(self.taggedProducts(tagdir))))
-                , 'dependencies'      : (
-                      " ".join(set(self.taggedDependencies(rules_dict, tagdir))))
-                , 'command_indent'    : (
-                      "\t"
-                      if False in [bool(i.invisible) for i in self.words]
-                      else "")
-                , 'command'           : self.commandLine()
-                , 'touch_preamble'    : self.touchPre(tagdir)
-                , 'touch_postamble'   : self.touchPost(tagdir)
-                , 'phony_rule'        : self.phonyRule()
-                , 'intermediate_rule' : self.intermediateRule()
-                , 'mkdir_if_necessary': self.mkdirCommands(tagdir)
-                , 'listing_rule'      : self.listingRule()
-                , 'tagged_rule'      : self.taggedRule(tagdir)
-                })
-
-    def taggedRule(self, tagdir):
-        if self.isTagged():
-            untagged = self.products()
-            tagged = self.taggedProducts(tagdir)
-            return (
-                "{untagged}: {tagged}\n\n".format(
-                    untagged = " ".join(set(untagged)),
-                    tagged =   " ".join(set(tagged))))
+    def prefilter(self, positions):
+        """A regexp matching whatever any of the given commands match, or
+        None if that would not be worth it (or not possible)."""
+        patterns = [self.commands[i].matchWord().pattern for i in positions]
+        if len(patterns) < 2 or [p for p in patterns if _backreference.search(p)]:
+            return None
+        try:
+            return re.compile("|".join(["(?:{0})".format(p) for p in patterns]))
+        except (re.error, AssertionError, OverflowError):
+            #e.g. clashing group names, or too many groups.
+            return None
+
+    def candidates(self, filename):
+        """Indices of the commands that might match the filename, in order."""
+        found = []
+        for length in self.prefixLengths:
+            if length > len(filename):
+                break
+            buckets = self.buckets.get(filename[:length], ())
+            for (suffix, positions, prefilter) in buckets:
+                if suffix and not (filename.endswith(suffix)
+                                   or filename.endswith(suffix + "\n")):
+                    continue
+                if prefilter is not None and not prefilter.match(filename):
+                    continue
+                found.extend(positions)
+        found.sort()
+        return found
+
+def matchFile(index, commands, filename, tried=None):
+    """The (command index, groups) of each command matching the filename.
+    If a list is given for `tried`, the (command index, seconds) of each
+    attempt is added to it."""
+    found = []
+    for n in index.candidates(filename):
+        if tried is not None:
+            started = time.time()
+            groups = commands[n].matchGroups(filename)
+            tried.append((n, time.time() - started))
         else:
-            return ""
+            groups = commands[n].matchGroups(filename)
+        if groups is not None:
+            found.append((n, groups))
+    return found
+
+##below this many files, a level is matched without the worker processes.
+minParallelFiles = 1000
 
-    def listingRule(self):
-        if [w for w in self.words if w.listing]:
+_workerMatcher = None
+
+def _startMatcher(commands):
+    global _workerMatcher
+    _workerMatcher = (MatchIndex(commands), commands)
+
+def _matchInWorker(filename):
+    (index, commands) = _workerMatcher
+    return matchFile(index, commands, filename)
+
+def _profileInWorker(filename):
+    (index, commands) = _workerMatcher
+    tried = []
+    return (matchFile(index, commands, filename, tried), tried)
+
+class Profile(object):
+    """Counts and times the work done for each command while generating
+    rules, and the number of new files at each depth of generation."""
+    def __init__(self, commands):
+        self.commands = list(commands)
+        n = len(self.commands)
+        self.tries = [0] * n
+        self.hits = [0] * n
+        self.merges = [0] * n
+        self.products = [0] * n
+        self.matchTime = [0.0] * n
+        self.substTime = [0.0] * n
+        self.depths = {}
+        self.phases = []
+        ##the peak memory as each phase ended; a phase that used less than
+        ##an earlier one shows the earlier one's peak.
+        self.peaks = {}
+        self.files = 0
+        self.rules = 0
+
+    def tried(self, tried):
+        for (n, seconds) in tried:
+            self.tries[n] = self.tries[n] + 1
+            self.matchTime[n] = self.matchTime[n] + seconds
+
+    def newFiles(self, depth, count):
+        if count:
+            self.depths[depth] = self.depths.get(depth, 0) + count
+
+    def phase(self, name, seconds, peakKB=None):
+        if peakKB is not None:
+            self.peaks[name] = max(self.peaks.get(name, 0), peakKB)
+        #phases repeated (by --run restarting) add up.
+        for (i, (existing, total)) in enumerate(self.phases):
+            if existing == name:
+                self.phases[i] = (name, total + seconds)
+                return
+        self.phases.append((name, seconds))
+
+    def report(self):
+        """The profile as a JSON-able dict."""
+        commands = [{"command": c.description(),
+                     "tries": self.tries[n],
+                     "hits": self.hits[n],
+                     "merges": self.merges[n],
+                     "products": self.products[n],
+                     "matchSeconds": round(self.matchTime[n], 6),
+                     "substSeconds": round(self.substTime[n], 6)}
+                    for (n, c) in enumerate(self.commands)]
+        return {"commands": commands,
+                "depths": [[d, self.depths[d]] for d in sorted(self.depths)],
+                "phases": [[name, round(s, 6)] for (name, s) in self.phases],
+                "peaksKB": [[name, self.peaks[name]] for (name, s) in self.phases
+                            if self.peaks.has_key(name)],
+                "files": self.files,
+                "rules": self.rules}
+
+    def writeTable(self, out):
+        out.write("{0:>3} {1:>9} {2:>8} {3:>8} {4:>9} {5:>9} {6:>9}  {7}\n"
+                  .format("#", "tries", "hits", "merges", "products",
+                          "match s", "subst s", "command"))
+        for (n, c) in enumerate(self.commands):
+            description = c.description()
+            if len(description) > 50:
+                description = description[:47] + "..."
+            out.write("{0:>3} {1:>9} {2:>8} {3:>8} {4:>9} {5:>9.3f} {6:>9.3f}  {7}\n"
+                      .format(n, self.tries[n], self.hits[n], self.merges[n],
+                              self.products[n], self.matchTime[n],
+                              self.substTime[n], description))
+        out.write("\ndepth {0}\n".format(" ".join(
+            ["{0}:{1}".format(d, self.depths[d]) for d in sorted(self.depths)])))
+        out.write("files {0}, rules {1}\n".format(self.files, self.rules))
+        out.write("seconds {0}\n".format(" ".join(
+            ["{0}:{1:.3f}".format(name, s) for (name, s) in self.phases])))
+        if self.peaks:
+            out.write("peak KB {0}\n".format(" ".join(
+                ["{0}:{1}".format(name, self.peaks[name])
+                 for (name, s) in self.phases if self.peaks.has_key(name)])))
+
+    def write(self, path):
+        """Write a table to stderr, or JSON to a file."""
+        if path == "-":
+            self.writeTable(sys.stderr)
+        else:
+            writeOutput(path, lambda out: json.dump(self.report(), out, indent=1,
+                                                    separators=(",", ": "),
+                                                    sort_keys=True))
+
+class RuleGraph(object):
+    """The state of rule generation: the list of files considered so far,
+    the command producing each target, and the depth at which each file
+    was generated. Each file is given an integer id when first seen, and
+    these tables are indexed by id. The commands found to match each file
+    are remembered too, and the files are grouped by the base files they
+    came from, so that a saved graph can be brought up to date when base
+    files come and go by generating only the groups that changed."""
+    def __init__(self, commands, maxdepth, maxfiles, verbose=False,
+                 pool=None, jobs=1, profile=None):
+        self.commands = list(commands)
+        self.index = MatchIndex(self.commands)
+        self.maxdepth = maxdepth
+        self.maxfiles = maxfiles
+        self.verbose = verbose
+        ##worker processes for matching, if any.
+        self.pool = pool
+        self.jobs = jobs
+        ##a Profile to count work in, if any.
+        self.profile = profile
+        ##the (command index, groups) of each command matching each file
+        ##considered.
+        self.matched = {}
+        ##the contents of the listings named in the rules, as of when the
+        ##graph was generated, and whether it has changed since it was saved.
+        self.listed = {}
+        self.changed = True
+        self.clear()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["index"]
+        state["pool"] = None
+        state["jobs"] = 1
+        state["profile"] = None
+        state["pending"] = {}
+        #rules are saved as the strings of their words and the templates
+        #those came from, which is far quicker to load than the words.
+        rules = unique([p for p in self.producers if p is not None])
+        numbers = dict([(id(r), n) for (n, r) in enumerate(rules)])
+        state["producers"] = array.array('l', [-1 if p is None else numbers[id(p)]
+                                              for p in self.producers])
+        shapes = {}
+        state["rules"] = [(shapes.setdefault(tuple([w.template for w in r.words]),
+                                             len(shapes)),
+                           [w.word for w in r.words], r.sources,
+                           r.wordsSeen is not None)
+                          for r in rules]
+        state["shapes"] = [shape for (shape, n) in
+                           sorted(shapes.items(), key=lambda item: item[1])]
+        return state
+
+    def __setstate__(self, state):
+        shapes = [[t.bound() for t in shape] for shape in state.pop("shapes")]
+        rules = []
+        for (shape, words, sources, merged) in state.pop("rules"):
+            r = MatchedCommand([c(w) for (c, w) in zip(shapes[shape], words)],
+                               sources)
+            if merged:
+                r.wordsSeen = {}
+                for w in r.words:
+                    r.wordsSeen.setdefault(w.word, w)
+            rules.append(r)
+        state["producers"] = [None if n < 0 else rules[n]
+                              for n in state["producers"]]
+        self.__dict__.update(state)
+        self.index = MatchIndex(self.commands)
+
+    def clear(self):
+        """Forget the files and rules, but not what matched them."""
+        self.base = []
+        ##the id of each file seen, and the file with each id.
+        self.ids = {}
+        self.paths = []
+        ##the ids of the files, in the order they are considered.
+        self.files = array.array('l')
+        ##track the commands used to generate each target (None for base
+        ##files and dependencies.)
+        self.producers = []
+        ##track the depth of generation for both targets and dependencies
+        ##of rules.
+        self.depths = array.array('l')
+        ##the ids of the files added to self.files while considering each
+        ##file (None if there were none.)
+        self.children = []
+        ##the group of each file. Each base file starts a group, and groups
+        ##are joined when their rules share a file, so no group's rules
+        ##depend on another's. Groups are named by the id of a file in
+        ##them; joined maps the name of a group that was joined to
+        ##another to that one's name.
+        self.owners = array.array('l')
+        self.joined = {}
+        ##the next file in self.files to consider.
+        self.position = 0
+        ##where each file last comes in self.files (or -1), and the ids
+        ##of the files of each merged command (by id) that may not have
+        ##been considered yet.
+        self.queued = array.array('l')
+        self.pending = {}
+
+    def newFile(self, path, depth, producer=None, owner=None):
+        """Give a file an id, in a group of its own unless given one."""
+        i = len(self.paths)
+        self.ids[path] = i
+        self.paths.append(path)
+        self.producers.append(producer)
+        self.depths.append(depth)
+        self.children.append(None)
+        self.owners.append(i if owner is None else owner)
+        self.queued.append(-1)
+        return i
+
+    def group(self, i):
+        """The name of the group a file is in."""
+        joined = self.joined
+        name = self.owners[i]
+        while joined.has_key(name):
+            name = joined[name]
+        if name != self.owners[i]:
+            self.owners[i] = name
+        return name
+
+    def join(self, name, i):
+        """Join a group to the group of a file, returning its name."""
+        other = self.group(i)
+        if other != name:
+            self.joined[other] = name
+        return name
+
+    def addFiles(self, files):
+        files = list(files)
+        self.base.extend(files)
+        for x in files:
+            i = self.ids.get(x)
+            if i is None:
+                i = self.newFile(x, 0)
+            else:
+                self.producers[i] = None
+                self.depths[i] = 0
+            self.queued[i] = len(self.files)
+            self.files.append(i)
+        if self.profile is not None:
+            self.profile.newFiles(0, len(files))
+
+    def expand(self):
+        ##For each target in order try matching a command pattern against
+        ##it. When a new target is generated, extend the file list (that
+        ##you are iterating over.)
+        profile = self.profile
+        while self.position < len(self.files):
+            #The files not yet considered make up the next level of
+            #generation. Which commands match them doesn't depend on the
+            #rest of the graph, so matching can be farmed out as long as
+            #the results are incorporated in order.
+            level = [self.paths[i] for i in self.files[self.position:]]
+            for (consideredTarget, found) in zip(level, self.matchLevel(level)):
+                for (n, groups) in found:
+                    command = self.commands[n]
+                    command.matchCount = command.matchCount + 1
+                    if profile is not None:
+                        started = time.time()
+                        matched = command.build(consideredTarget, groups)
+                        profile.substTime[n] = (profile.substTime[n]
+                                                + time.time() - started)
+                    else:
+                        matched = command.build(consideredTarget, groups)
+                    self.incorporate(n, consideredTarget, matched)
+                self.position = self.position + 1
+        self.pending = {}
+
+    def waiting(self, command):
+        """The ids of the files of a command that may not have been
+        considered yet, forgetting them."""
+        found = self.pending.pop(id(command), None)
+        if found is None:
+            ids = self.ids
+            found = [ids[p] for p in command.products() + command.dependencies()]
+        return found
+
+    def matchLevel(self, files):
+        """For each file, the (command index, groups) of each command that
+        matches it, matching only the files not seen before."""
+        matched = self.matched
+        todo = distinct([f for f in files if not matched.has_key(f)])
+        for (f, found) in zip(todo, self.matchFiles(todo)):
+            matched[f] = found
+        return [matched[f] for f in files]
+
+    def matchFiles(self, files):
+        profile = self.profile
+        if self.pool is None or len(files) < minParallelFiles:
+            if profile is None:
+                return [matchFile(self.index, self.commands, f) for f in files]
+            results = []
+            for f in files:
+                tried = []
+                results.append((matchFile(self.index, self.commands, f, tried), tried))
+        else:
+            chunksize = len(files) // (4 * self.jobs) + 1
+            if profile is None:
+                return self.pool.map(_matchInWorker, files, chunksize)
+            results = self.pool.map(_profileInWorker, files, chunksize)
+        for (found, tried) in results:
+            profile.tried(tried)
+        return [found for (found, tried) in results]
+
+    def incorporate(self, n, consideredTarget, matchedCommand):
+        """Add a command matched from a file, merging it into any commands
+        that already produce the same targets."""
+        verbose = self.verbose
+        ids = self.ids
+        producers = self.producers
+        depths = self.depths
+        matchedCommand.sources = [(n, consideredTarget)]
+        target = ids[consideredTarget]
+        group = self.group(target)
+        if verbose:
+            print('-'*3, file=sys.stderr)
+            print("matched: {0}".format(consideredTarget), file=sys.stderr)
+            print("with command: {0}".format(matchedCommand.description()),
+                  file=sys.stderr)
+        #See what files are produced by this command.
+        #Add them to the products list for perusal.
+        products = matchedCommand.products()
+        #Are some of these products already being produced?
+        #If so the commands will have to be merged.
+        previousCommands = []
+        for o in products:
+            i = ids.get(o)
+            if i is not None:
+                group = self.join(group, i)
+                if producers[i] is not None:
+                    previousCommands.append(producers[i])
+        previousCommands = unique(previousCommands)
+
+        if len(previousCommands) > 0:
+            #only the words the merge adds can bring in new files. The
+            #cost of a merge is in proportion to the words added, so
+            #folding many matches into one command takes linear time.
+            mergedCommand = previousCommands[0]
+            absorbed = previousCommands[1:]
+            waiting = [i for c in previousCommands for i in self.waiting(c)]
+            added = mergedCommand.merge(*(absorbed + [matchedCommand]))
+            for c in absorbed:
+                for i in c.products():
+                    producers[ids[i]] = mergedCommand
+            newProducts = wordProducts(added)
+            newDependencies = wordDependencies(added)
+            if verbose:
+                print("merged into command: {0}"
+                      .format(mergedCommand.commandLine()), file=sys.stderr)
+        else:
+            mergedCommand = matchedCommand
+            newProducts = products
+            newDependencies = mergedCommand.dependencies()
+        prevDepth = depths[target]
+
+        if prevDepth >= self.maxdepth:
+            raise Exception("target generation went too deep at {0}"
+                            .format(consideredTarget))
+
+        newFiles = [p for p in newProducts + newDependencies
+                    if not ids.has_key(p)]
+        if verbose:
+            print("new files (depth {0}): {1}"
+                  .format(prevDepth+1, " ".join(newFiles)), file=sys.stderr)
+        if newFiles and self.children[target] is None:
+            self.children[target] = []
+        for p in newFiles:
+            i = ids.get(p)
+            if i is None:
+                i = self.newFile(p, prevDepth+1, owner=group)
+            self.queued[i] = len(self.files)
+            self.files.append(i)
+            self.children[target].append(i)
+
+        for p in newProducts:
+            producers[ids[p]] = mergedCommand
+
+        if len(self.files) >= self.maxfiles:
+            raise Exception("too many files generated at {0}"
+                            .format(consideredTarget))
+
+        for p in newProducts + newDependencies:
+            i = ids[p]
+            depths[i] = prevDepth+1
+            group = self.join(group, i)
+        if len(previousCommands) > 0:
+            #every file of the merged command is now at the new depth. Only
+            #those not yet considered will have their depth looked at
+            #again, so only they are set, which keeps a merge from costing
+            #as much as the whole command.
+            queued = self.queued
+            position = self.position
+            added = [ids[p] for p in newProducts + newDependencies]
+            waiting = unique([i for i in waiting + added if queued[i] >= position],
+                             lambda i: i)
+            for i in waiting:
+                depths[i] = prevDepth+1
+            self.pending[id(mergedCommand)] = waiting
+
+        profile = self.profile
+        if profile is not None:
+            profile.hits[n] = profile.hits[n] + 1
+            if len(previousCommands) > 0:
+                profile.merges[n] = profile.merges[n] + 1
+            fresh = set(newFiles)
+            made = [p for p in distinct(newProducts) if p in fresh]
+            profile.products[n] = profile.products[n] + len(made)
+            profile.newFiles(prevDepth+1, len(newFiles))
+
+    def rules(self):
+        # commands uniquely in order of creation.
+        producers = self.producers
+        return unique([producers[i] for i in self.files
+                       if producers[i] is not None])
+
+    def listings(self):
+        """The current contents of every listing file named in a rule."""
+        return dict([(w.word, getList(w.word))
+                     for r in self.rules()
+                     for w in r.words if w.listing])
+
+    def update(self, files):
+        """Bring the graph up to date with a new set of base files and the
+        current listings, giving the rules a fresh run would. Groups whose
+        base files and listings haven't changed are kept as they are, and
+        the rest generated again, matching only the files not seen before
+        against the commands. Returns the number of files matched."""
+        files = list(files)
+        known = len(self.matched)
+        if not self.reuse(files):
+            for c in self.commands:
+                c.matchCount = 0
+            self.clear()
+            self.addFiles(files)
+            self.expand()
+            self.changed = True
+        fresh = len(self.matched) - known
+        #forget the files that no longer come up.
+        if len(self.matched) > len(self.ids):
+            for f in [f for f in self.matched if not self.ids.has_key(f)]:
+                del self.matched[f]
+        self.listed = self.listings()
+        return fresh
+
+    def reuse(self, files):
+        """Generate the groups of the graph that the new base files or a
+        listing change, keeping the rest, and list the files in the order
+        a fresh run would consider them. Returns False if the graph has to
+        be generated again in full instead."""
+        if not self.paths or len(set(files)) < len(files):
+            return False
+        if len(set(self.base)) < len(self.base):
+            return False
+        ids = self.ids
+        group = self.group
+        position = dict([(f, n) for (n, f) in enumerate(files)])
+        bases = {}
+        for f in self.base:
+            bases.setdefault(group(ids[f]), []).append(f)
+        #keep the groups with all their base files, in the same order.
+        kept = set()
+        for (name, fs) in bases.items():
+            at = [position.get(f, -1) for f in fs]
+            if -1 not in at and at == sorted(at):
+                kept.add(name)
+        for (listing, contents) in self.listed.items():
+            if ids.has_key(listing) and getList(listing) != contents:
+                kept.discard(group(ids[listing]))
+        while True:
+            #a group is generated again if the others' rules touch it.
+            keptBase = set([f for name in kept for f in bases[name]])
+            graph = RuleGraph(self.commands, self.maxdepth, self.maxfiles,
+                              self.verbose, self.pool, self.jobs, self.profile)
+            graph.matched = self.matched
+            try:
+                graph.addFiles([f for f in files if f not in keptBase])
+                graph.expand()
+            except Exception:
+                #let a full run say what's wrong.
+                return False
+            touched = set([group(ids[p]) for p in graph.paths if ids.has_key(p)])
+            if not touched & kept:
+                break
+            kept = kept - touched
+        self.changed = len(kept) < len(bases) or files != self.base
+        #forget the files of the other groups, leaving gaps in the tables,
+        #and add the new graph's files at the end. Each file of a group is
+        #a base file or was added while considering one of its files.
+        dropped = [ids[f] for name in bases if name not in kept
+                   for f in bases[name]]
+        for i in dropped:
+            if ids.has_key(self.paths[i]):
+                del ids[self.paths[i]]
+                dropped.extend(self.children[i] or ())
+                self.producers[i] = None
+                self.children[i] = None
+        if len(self.paths) > 2 * len(ids) + len(graph.paths):
+            #mostly gaps; start afresh.
+            return False
+        offset = len(self.paths)
+        for i in range(len(graph.paths)):
+            self.newFile(graph.paths[i], graph.depths[i], graph.producers[i],
+                         offset + graph.group(i))
+            if graph.children[i] is not None:
+                self.children[offset + i] = [offset + c for c in graph.children[i]]
+        #consider each file's children after it, as expand() would.
+        self.base = files
+        self.files = array.array('l', [ids[f] for f in files])
+        children = self.children
+        position = 0
+        while position < len(self.files):
+            added = children[self.files[position]]
+            if added:
+                self.files.extend(added)
+            position = position + 1
+        self.position = position
+        self.queued = array.array('l', [-1]) * len(self.paths)
+        for (n, i) in enumerate(self.files):
+            self.queued[i] = n
+        if len(self.files) >= self.maxfiles:
+            return False
+        for c in self.commands:
+            c.matchCount = 0
+        for i in self.files:
+            for (n, groups) in self.matched[self.paths[i]]:
+                self.commands[n].matchCount = self.commands[n].matchCount + 1
+        return True
+
+    def withoutProducts(self, files):
+        """Leave those of the given files that a rule makes out of the base
+        files, bringing the graph up to date. Returns how many there were."""
+        (ids, producers) = (self.ids, self.producers)
+        made = set([f for f in files
+                    if ids.has_key(f) and producers[ids[f]] is not None])
+        if made:
+            self.update([f for f in self.base if f not in made])
+        return len(made)
+
+    def warnUnmatched(self):
+        unmatchedCommands = [c for c in self.commands if c.matchCount == 0]
+        for c in unmatchedCommands:
+            print("warning: unmatched command: {0}\n"
+                  .format(c.description()),
+                  file=sys.stderr)
+
+def toBytes(s):
+    return s if isinstance(s, bytes) else s.encode("utf-8")
+
+cacheVersion = 5
+
+def ruleHash(commands, maxdepth):
+    """A digest identifying a set of command rules."""
+    flags = ["pattern", "match", "input", "output", "once", "listing",
+             "phony", "mkdir", "intermediate", "invisible", "tagged"]
+    desc = repr([cacheVersion, maxdepth] +
+                [[[getattr(w, f) for f in flags] for w in c.words]
+                 for c in commands])
+    return hashlib.sha1(toBytes(desc)).hexdigest()
+
+def cachePath(tagdir):
+    return os.path.join(tagdir, ".monkcache")
+
+def loadGraph(path, files, commands, maxdepth, maxfiles, verbose=False,
+              pool=None, jobs=1, profile=None):
+    """Bring the rule graph saved by saveGraph up to date with the base
+    files, or return None if there is none usable for these commands."""
+    #the graph is many small objects that all stay; collecting garbage
+    #while they're made only slows loading down.
+    gc.disable()
+    try:
+        with open(path, 'rb') as f:
+            if pickle.load(f) != ruleHash(commands, maxdepth):
+                return None
+            graph = pickle.load(f)
+    except Exception:
+        #missing, unreadable or from an incompatible monk; start over.
+        return None
+    finally:
+        gc.enable()
+    graph.maxfiles = maxfiles
+    graph.verbose = verbose
+    graph.pool = pool
+    graph.jobs = jobs
+    graph.profile = profile
+    fresh = graph.update(files)
+    if verbose:
+        print("cache: matched {0} of {1} files, {2} rules"
+              .format(fresh, len(graph.matched), len(graph.rules())),
+              file=sys.stderr)
+    return graph
+
+def saveGraph(path, graph):
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    graph.changed = False
+    temp = path + ".tmp"
+    gc.disable()
+    try:
+        with open(temp, 'wb') as f:
+            #the key comes first, so a stale graph needn't be loaded.
+            pickle.dump(ruleHash(graph.commands, graph.maxdepth), f,
+                        pickle.HIGHEST_PROTOCOL)
+            pickle.dump(graph, f, pickle.HIGHEST_PROTOCOL)
+    finally:
+        gc.enable()
+    os.rename(temp, path)
+
+def listDirectory(path):
+    """(name, whether it's a directory) for each entry in a directory.
+    Symbolic links to directories count as files, and aren't followed."""
+    if scandir is not None:
+        return [(e.name, e.is_dir(follow_symlinks=False)) for e in scandir(path)]
+    entries = []
+    for name in os.listdir(path):
+        full = os.path.join(path, name)
+        entries.append((name, os.path.isdir(full) and not os.path.islink(full)))
+    return entries
+
+class FileFinder(object):
+    """Finds base files in the filesystem or the git index. Directories
+    that no --match pattern could match a file in (judging by the literal
+    text the patterns begin with) aren't looked in, nor are .git
+    directories, the tag directory or anything matching one of the ignore
+    globs."""
+    def __init__(self, commands, ignore=(), tagdir=None):
+        self.prefixes = distinct([literalPrefix(c.matchWord().pattern)
+                                  for c in commands])
+        self.ignore = list(ignore)
+        self.tagdir = os.path.normpath(tagdir) if tagdir else None
+        self.directories = {}
+        ##the directories scan() looked in.
+        self.walked = []
+        self.readIndex = False
+
+    def ignored(self, path):
+        name = os.path.basename(path)
+        for pattern in self.ignore:
+            if fnmatch.fnmatch(path, pattern) or fnmatch.fnmatch(name, pattern):
+                return True
+        return False
+
+    def mayMatchIn(self, directory):
+        for p in self.prefixes:
+            if p[:len(directory)] == directory[:len(p)]:
+                return True
+        return False
+
+    def keepDirectory(self, directory):
+        """Whether to look for files in a directory (and its parents)."""
+        kept = self.directories.get(directory)
+        if kept is None:
+            parent = os.path.dirname(directory)
+            kept = ((parent == "" or self.keepDirectory(parent))
+                    and os.path.basename(directory) != ".git"
+                    and directory != self.tagdir
+                    and not self.ignored(directory)
+                    and self.mayMatchIn(directory + "/"))
+            self.directories[directory] = kept
+        return kept
+
+    def scan(self, top):
+        """The files under a directory, sorted the way git sorts them."""
+        top = os.path.normpath(top)
+        if top == os.curdir:
+            top = ""
+        elif not self.keepDirectory(top):
+            return []
+        found = []
+        self.walk(top, found)
+        return found
+
+    def walk(self, directory, found):
+        self.walked.append(directory or os.curdir)
+        prefix = directory + "/" if directory else ""
+        entries = []
+        for (name, isdir) in listDirectory(directory or os.curdir):
+            path = prefix + name
+            if isdir:
+                if self.keepDirectory(path):
+                    entries.append((path + "/", path))
+            elif not self.ignored(path):
+                entries.append((path, None))
+        entries.sort()
+        for (key, subdirectory) in entries:
+            if subdirectory is None:
+                found.append(key)
+            else:
+                self.walk(subdirectory, found)
+
+    def gitIndex(self):
+        """The files in the git index, as listed by `git ls-files`."""
+        self.readIndex = True
+        git = subprocess.Popen(["git", "ls-files", "-z"], stdout=subprocess.PIPE)
+        listed = git.communicate()[0]
+        if git.returncode != 0:
+            raise Exception("git ls-files failed with status {0}"
+                            .format(git.returncode))
+        if not isinstance(listed, str):
+            listed = listed.decode("utf-8")
+        found = []
+        for path in listed.split("\0"):
+            if not path:
+                continue
+            directory = os.path.dirname(path)
+            if directory and not self.keepDirectory(directory):
+                continue
+            if not self.ignored(path):
+                found.append(path)
+        return found
+
+def findFiles(files, commands, scan=None, git_index=False, ignore=None,
+              finder=None, tagdir=None):
+    """The base files given on the command line, followed by any found
+    with --scan or --git-index."""
+    files = list(files or [])
+    if not scan and not git_index:
+        return files
+    if finder is None:
+        finder = FileFinder(commands, ignore or [], tagdir)
+    for top in scan or []:
+        files.extend(finder.scan(top))
+    if git_index:
+        files.extend(finder.gitIndex())
+    return distinct(files)
+
+def buildGraph(files, commands, maxdepth, maxfiles, verbose=False,
+               cache=False, tagdir="tags", jobs=1, profile=None,
+               scan=None, git_index=False, ignore=None, found=(), finder=None,
+               **kwargs):
+    """The rule graph for the base files. Files found by --scan (or given
+    as `found`) that a rule makes are outputs of an earlier build, and
+    are left out."""
+    given = set(files or [])
+    files = findFiles(files, commands, scan, git_index, ignore, finder, tagdir)
+    if scan:
+        found = [f for f in files if f not in given]
+    pool = None
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs, _startMatcher, (list(commands),))
+    try:
+        graph = None
+        if cache:
+            graph = loadGraph(cachePath(tagdir), files, commands,
+                              maxdepth, maxfiles, verbose, pool, jobs, profile)
+        if graph is None:
+            graph = RuleGraph(commands, maxdepth, maxfiles, verbose, pool,
+                              jobs, profile)
+            graph.addFiles(files)
+            graph.expand()
+            graph.listed = graph.listings()
+        graph.withoutProducts(found)
+    finally:
+        if pool is not None:
+            pool.terminate()
+    graph.pool = None
+    if cache and graph.changed:
+        saveGraph(cachePath(tagdir), graph)
+    graph.warnUnmatched()
+    return graph
+
+def generateRules(profile=None, **kwargs):
+    graph = buildGraph(profile=profile, **kwargs)
+    rules = graph.rules()
+    if profile is not None:
+        profile.files = len(graph.files)
+        profile.rules = len(rules)
+    return rules
+
+def goalRules(rules, goals):
+    """The rules needed to make the targets that match any of the goal
+    regexps (in full), and those targets."""
+    patterns = [re.compile("(?:{0})\\Z".format(g)) for g in goals]
+    producers = {}
+    named = {}
+    names = []
+    for r in rules:
+        for p in r.products():
+            producers[p] = r
+            names.append(p)
+        for w in r.words:
+            if w.phony and not (w.input or w.output):
+                named.setdefault(w.word, []).append(r)
+                names.append(w.word)
+    targets = [t for t in distinct(names) if [p for p in patterns if p.match(t)]]
+    if not targets:
+        raise Exception("no rule makes a target matching {0}"
+                        .format(" ".join(goals)))
+    needed = {}
+    stack = [r for t in targets
+             for r in ([producers[t]] if producers.has_key(t) else named[t])]
+    while stack:
+        r = stack.pop()
+        if id(r) in needed:
+            continue
+        needed[id(r)] = r
+        stack.extend([producers[d] for d in r.dependencies()
+                      if producers.has_key(d)])
+    return ([r for r in rules if id(r) in needed], targets)
+
+def rulePools(commands, pools):
+    """The (name, size) of the pool each command's rules run in, by
+    command index, or None for a command without one."""
+    result = []
+    for c in commands:
+        name = getattr(c, "pool", None)
+        if name is None:
+            result.append(None)
+        elif not (pools or {}).has_key(name):
+            raise Exception("pool {0} isn't declared (with --pool {0}:SIZE), "
+                            "in command {1}".format(name, c.description()))
+        else:
+            result.append((name, pools[name]))
+    return result
+
+def rulePool(rule, pools):
+    if not pools or not rule.sources:
+        return None
+    return pools[rule.sources[0][0]]
+
+def ruleOrder(rules):
+    """The rules in dependency order, leaving out any on a cycle, and the
+    rules each rule depends on, by id."""
+    producers = {}
+    for r in rules:
+        for p in r.products():
+            producers[p] = r
+    upstream = {}
+    downstream = dict([(id(r), []) for r in rules])
+    waiting = {}
+    for r in rules:
+        upstream[id(r)] = unique([producers[d] for d in r.dependencies()
+                                  if producers.has_key(d) and producers[d] is not r])
+        waiting[id(r)] = len(upstream[id(r)])
+        for u in upstream[id(r)]:
+            downstream[id(u)].append(r)
+    ready = [r for r in rules if waiting[id(r)] == 0]
+    order = []
+    while ready:
+        r = ready.pop()
+        order.append(r)
+        for d in downstream[id(r)]:
+            waiting[id(d)] = waiting[id(d)] - 1
+            if waiting[id(d)] == 0:
+                ready.append(d)
+    return (order, upstream)
+
+def ruleLevels(rules):
+    """The length of the longest chain of rules leading to each rule, by
+    id. Rules on a cycle are left out."""
+    (order, upstream) = ruleOrder(rules)
+    levels = {}
+    for r in order:
+        levels[id(r)] = max([levels[id(u)] + 1 for u in upstream[id(r)]] or [0])
+    return levels
+
+def varies(word):
+    """Whether a word of a matched command depends on the match."""
+    return word.match or bool(formatFields(word.template.pattern))
+
+class BatchCommand(MatchedCommand):
+    """Several rules made from matches of one --batch command, run by a
+    single invocation.
+
+    The command is given the words of the first rule that don't depend on
+    the match, followed by the name of a manifest with a line for each
+    rule that is out of date: its words that do depend on the match (the
+    matched file, and the outputs formatted from it), separated by tabs.
+    `monk.py batch` writes that manifest from one written with the rules,
+    which holds each rule's words, inputs and outputs."""
+    def __init__(self, members, tagdir):
+        words = list(members[0].words)
+        for m in members[1:]:
+            words.extend([w for w in m.words if varies(w)])
+        super(BatchCommand, self).__init__(words, [s for m in members
+                                                   for s in m.sources])
+        self.members = members
+        firstOutput = [w for w in words if w.output][0]
+        self.manifest = os.path.join(tagdir, firstOutput.word + ".batch")
+        self.words.append(UnmatchedWord(self.manifest, input=True,
+                                        invisible=True).bound()(self.manifest))
+        self.setTagged()
+
+    def commandLine(self):
+        fixed = [w.word for w in self.members[0].words
+                 if not w.invisible and not varies(w)]
+        return "{0} batch {1} -- {2}".format(monkCommand(relative=True),
+                                             shellQuote(self.manifest),
+                                             shellQuote(" ".join(fixed)))
+
+    def writeManifest(self, out):
+        json.dump({"members": [{"words": [w.word for w in m.words
+                                          if not w.invisible and varies(w)],
+                                "inputs": distinct(m.dependencies()),
+                                "outputs": distinct(m.products())}
+                               for m in self.members]},
+                  out, sort_keys=True)
+
+def batchRules(rules, commands, tagdir="tags"):
+    """Replace the rules made from single matches of commands with --batch
+    by BatchCommands of up to that many rules each. Only rules at the
+    same depth in the graph are batched together, so none of them
+    depends on another."""
+    if not [c for c in commands if getattr(c, "batch", None)]:
+        return rules
+    levels = ruleLevels(rules)
+    groups = {}
+    order = []
+    for r in rules:
+        if (len(r.sources) != 1 or not levels.has_key(id(r)) or
+            not getattr(commands[r.sources[0][0]], "batch", None) or
+            [w for w in r.words if w.listing or w.once or
+             (w.phony and (w.input or w.output))] or
+            not [w for w in r.words if w.output]):
+            continue
+        key = (r.sources[0][0], levels[id(r)])
+        if not groups.has_key(key):
+            groups[key] = []
+            order.append(key)
+        groups[key].append(r)
+    batches = {}
+    for key in order:
+        size = commands[key[0]].batch
+        members = groups[key]
+        for start in range(0, len(members), size):
+            #even a batch of one, since the command expects a manifest.
+            chunk = members[start:start + size]
+            batch = BatchCommand(chunk, tagdir)
+            for r in chunk:
+                batches[id(r)] = None
+            batches[id(chunk[0])] = batch
+    return [batches.get(id(r), r) for r in rules
+            if batches.get(id(r), r) is not None]
+
+def writeManifests(rules):
+    """Write the manifest of each BatchCommand, once its rules are written
+    out or about to run."""
+    for r in rules:
+        if not isinstance(r, BatchCommand):
+            continue
+        directory = os.path.dirname(r.manifest)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        writeOutput(r.manifest, r.writeManifest, changedOnly=True)
+
+def ruleName(rule):
+    products = distinct(rule.products())
+    if len(products) > 2:
+        return "{0} (and {1} more)".format(products[0], len(products) - 1)
+    return " ".join(products) or rule.commandLine()
+
+def timingReport(rules, commands, log, out):
+    """Combine the timings logged by `monk.py exec --timelog` with the
+    rules: the critical path, CPU and wall time, how many commands ran at
+    once on average, and the slowest rules of each command. A rule that
+    ran more than once is counted by its latest run; to report on a
+    single build, start it with an empty log. Returns 1 if there are no
+    timings to report, or 0."""
+    entries = []
+    if os.path.exists(log):
+        with open(log) as f:
+            entries = [json.loads(line) for line in f if line.strip()]
+    if not entries:
+        print("monk: no timing log at {0}; build with --timelog {0} first"
+              .format(log), file=sys.stderr)
+        return 1
+    producers = {}
+    for r in rules:
+        for p in r.products():
+            producers[p] = r
+    latest = {}
+    for e in entries:
+        made = [producers[o] for o in e["outputs"] if producers.has_key(o)]
+        if made:
+            latest[id(made[0])] = (made[0], e)
+    wall = max([e["end"] for e in entries]) - min([e["start"] for e in entries])
+    busy = sum([e["end"] - e["start"] for e in entries])
+    cpu = sum([e["user"] + e["system"] for e in entries])
+    out.write("{0} commands logged, for {1} of {2} rules\n"
+              .format(len(entries), len(latest), len(rules)))
+    out.write("wall time {0:.1f}s, busy {1:.1f}s (on average {2:.2f} running)\n"
+              .format(wall, busy, busy / wall if wall else 0))
+    out.write("cpu time {0:.1f}s ({1:.2f} of wall time)\n"
+              .format(cpu, cpu / wall if wall else 0))
+    #the chain of rules with the most time between them.
+    durations = dict([(k, e["end"] - e["start"]) for (k, (r, e)) in latest.items()])
+    (order, upstream) = ruleOrder(rules)
+    length = {}
+    previous = {}
+    for r in order:
+        before = upstream[id(r)]
+        prev = max(before, key=lambda u: length[id(u)]) if before else None
+        previous[id(r)] = prev
+        length[id(r)] = durations.get(id(r), 0) + (length[id(prev)] if prev else 0)
+    if order:
+        r = max(order, key=lambda r: length[id(r)])
+        out.write("critical path {0:.1f}s ({1:.2f} of wall time):\n"
+                  .format(length[id(r)], length[id(r)] / wall if wall else 0))
+        path = []
+        while r is not None:
+            if durations.has_key(id(r)):
+                path.append(r)
+            r = previous[id(r)]
+        for r in reversed(path):
+            out.write("  {0:8.1f}s  {1}\n".format(durations[id(r)], ruleName(r)))
+    byCommand = {}
+    for (r, e) in latest.values():
+        byCommand.setdefault(r.sources[0][0] if r.sources else -1, []).append((r, e))
+    out.write("slowest rules by command:\n")
+    for (n, timed) in sorted(byCommand.items(),
+                             key=lambda x: -sum([e["end"] - e["start"]
+                                                 for (r, e) in x[1]])):
+        timed.sort(key=lambda x: x[1]["start"] - x[1]["end"])
+        total = sum([e["end"] - e["start"] for (r, e) in timed])
+        out.write("  {0}\n    {1} rules, {2:.1f}s in all\n"
+                  .format(commands[n].description() if n >= 0 else "?",
+                          len(timed), total))
+        for (r, e) in timed[:3]:
+            out.write("    {0:8.1f}s {1:8d}KB  {2}\n"
+                      .format(e["end"] - e["start"], e["maxrssKB"], ruleName(r)))
+    return 0
+
+class RuleFields(object):
+    """The parts of a rule that are written out, each computed once.
+    Lists are in order of first appearance with duplicates removed, so
+    that the output doesn't depend on set ordering."""
+    def __init__(self, rule, tagdir):
+        words = rule.words
+        self.rule = rule
+        self.products = distinct(rule.products())
+        self.dependencies = distinct(rule.dependencies())
+        self.tagged = rule.isTagged()
+        #set for static pattern rules.
+        self.pattern = None
+        if self.tagged:
+            #replicating the the first output will suffice.
+            firstOutput = [word for word in words if word.output][0]
+            self.tag = os.path.join(tagdir, firstOutput.word)
+            self.targets = [self.tag]
+        else:
+            self.tag = None
+            self.targets = self.products
+        self.command = rule.commandLine()
+        self.visible = bool([w for w in words if not w.invisible])
+        self.phony = distinct([w.word for w in words if w.phony])
+        phony = set(self.phony)
+        self.outputs = [p for p in self.products if p not in phony]
+        self.inputs = self.dependencies
+        self.phonyTargets = distinct([w.word for w in words
+                                      if w.phony and not (w.output or w.input)])
+        self.intermediate = distinct([w.word for w in words if w.intermediate])
+        self.listings = distinct([w.word for w in words if w.listing])
+        made = [w.word for w in words if w.mkdir]
+        if self.tagged:
+            made.append(self.tag)
+        self.mkdirs = distinct([os.path.split(x)[0] for x in made])
+
+##stands in for the stem while looking for rules that differ only in it.
+stemMark = "\0"
+
+def formatFields(pattern):
+    """The (name, format spec, conversion) of each replacement field in a
+    format string."""
+    return [(name, spec, conversion)
+            for (text, name, spec, conversion) in string.Formatter().parse(pattern)
+            if name is not None]
+
+def stemShapes(rule):
+    """If a rule was made from a single match, and each of its words is
+    either fixed or fixed text around one and the same group of the
+    match (the stem), return the stem and the words with stemMark in
+    place of the stem. Otherwise return None."""
+    matched = [w for w in rule.words if w.match]
+    if len(rule.sources) != 1 or len(matched) != 1:
+        return None
+    matched = matched[0]
+    used = set()
+    for w in rule.words:
+        if w.match:
+            continue
+        for (name, spec, conversion) in formatFields(w.pattern):
+            if spec or conversion is not None or not name.isdigit():
+                return None
+            used.add(int(name))
+    if len(used) != 1:
+        return None
+    k = used.pop()
+    match = matched.template.regexp().match(matched.word)
+    if match is None or k >= len(match.groups()):
+        return None
+    (start, end) = match.span(k + 1)
+    stem = match.group(k + 1)
+    if start < 0 or start == end or "%" in stem:
+        return None
+    fill = [""] * k + [stemMark]
+    shapes = []
+    for w in rule.words:
+        if w.match:
+            shape = w.word[:start] + stemMark + w.word[end:]
+        else:
+            shape = w.pattern.format(*fill)
+        if "%" in shape or (shape.count(stemMark) > 1 and (w.input or w.output)):
+            return None
+        shapes.append(shape)
+    return (stem, shapes)
+
+class PatternFields(object):
+    """A static pattern rule standing for several rules that differ only
+    in their stem. Shaped is the RuleFields of the rules with stemMark in
+    place of the stem."""
+    def __init__(self, shaped, members):
+        def recipe(text):
+            return text.replace(stemMark, "$*")
+        self.rule = members[0].rule
+        self.targets = [m.outputs[0] for m in members]
+        self.products = self.targets
+        self.pattern = shaped.outputs[0].replace(stemMark, "%")
+        self.dependencies = [d.replace(stemMark, "%") for d in shaped.dependencies]
+        self.inputs = [recipe(d) for d in shaped.dependencies]
+        self.outputs = [recipe(o) for o in shaped.outputs]
+        self.command = recipe(shaped.command)
+        self.visible = shaped.visible
+        #the stem may have directories in it.
+        made = [w.word for w in shaped.rule.words if w.mkdir]
+        self.mkdirs = distinct(["$(dir {0})".format(recipe(x)) if stemMark in x
+                                else os.path.split(x)[0] for x in made])
+        self.intermediate = distinct([i for m in members for i in m.intermediate])
+        self.tagged = False
+        self.phony = []
+        self.listings = []
+
+class MakefileEmitter(object):
+    """Writes a Makefile for a list of rules, one rule at a time. With
+    patterns set, rules that differ only in the stem of their match are
+    written as one static pattern rule."""
+    def __init__(self, rules, tagdir, wrapper=None, patterns=False, goals=None,
+                 pools=None):
+        self.goals = goals
+        self.pools = pools
+        for r in rules:
+            r.setTagged()
+        self.fields = [RuleFields(r, tagdir) for r in rules]
+        self.wrapper = wrapper
+        self.producers = {}
+        for f in self.fields:
+            for o in f.products:
+                self.producers[o] = f
+        self.entries = self.fields
+        if patterns:
+            self.entries = self.collapse(tagdir)
+
+    def shape(self, f, tagdir):
+        """The RuleFields of a rule with its stem marked, if it can be part
+        of a pattern rule, or None."""
+        if f.tagged or f.phony or f.listings or len(f.outputs) != 1:
+            return None
+        if [d for d in f.dependencies if self.tagIfTagged(d) != d]:
+            return None
+        shapes = stemShapes(f.rule)
+        if shapes is None:
+            return None
+        (stem, shapes) = shapes
+        if self.wrapper is not None and shellQuote(stem) != stem:
+            return None
+        words = [w.template.bound()(shape) for (w, shape) in zip(f.rule.words, shapes)]
+        shaped = RuleFields(MatchedCommand(words), tagdir)
+        if shaped.outputs[0].count(stemMark) != 1:
+            return None
+        return shaped
+
+    def collapse(self, tagdir):
+        """The rules, with those that have the same shape grouped into
+        pattern rules where the rule of the first of them was."""
+        groups = {}
+        entries = []
+        for f in self.fields:
+            shaped = self.shape(f, tagdir)
+            if shaped is None:
+                entries.append((None, [f]))
+                continue
+            key = (shaped.command, shaped.visible, tuple(shaped.dependencies),
+                   tuple(shaped.outputs), tuple(shaped.mkdirs),
+                   bool(shaped.intermediate))
+            if not groups.has_key(key):
+                groups[key] = (shaped, [])
+                entries.append(groups[key])
+            groups[key][1].append(f)
+        return [PatternFields(shaped, members) if len(members) > 1 else members[0]
+                for (shaped, members) in entries]
+
+    def tagIfTagged(self, dep):
+        #look up a file and check if it needs to be a tagged file
+        producer = self.producers.get(dep)
+        if producer is not None and producer.tagged:
+            return producer.tag
+        else:
+            return dep
+
+    def rule(self, f):
+        targets = " ".join(f.targets)
+        if f.pattern is not None:
+            targets = "{0}: {1}".format(targets, f.pattern)
+        parts = ["{0}: {1}\n".format(
+            targets,
+            " ".join(distinct([self.tagIfTagged(d) for d in f.dependencies])))]
+        if f.mkdirs:
+            parts.append("\t" + "\n\t".join(["mkdir -p {0}".format(i)
+                                              for i in f.mkdirs if i != ""])
+                         + "\n")
+        if f.tagged:
+            parts.append("\ttouch {0}".format(" ".join(f.targets))
+                         + ("\n" if f.command else ""))
+        parts.append(("\t" if f.visible else "") + self.command(f))
+        if f.tagged and f.command:
+            parts.append(" || ( rm {0} && false )".format(" ".join(f.targets)))
+        parts.append("\n\n")
+        if f.phony:
+            parts.append("\n\n".join(["{0}: {1}".format(x, " ".join(f.products))
+                                       for x in f.phonyTargets]))
+            parts.append("\n\n.PHONY: {0}\n\n".format(" ".join(f.phony)))
+        if f.intermediate:
+            parts.append(".INTERMEDIATE: {0}\n\n".format(" ".join(f.intermediate)))
+        if f.listings:
             #changes in output list files should trigger a reboot.
             #as should changes in input list file.
-            return ("$(lastword $(MAKEFILE_LIST)): {0}\n\n"
-                    .format(" ".join(x.word for x in self.words if x.listing)))
-        else:
-            return ""
+            parts.append("$(lastword $(MAKEFILE_LIST)): {0}\n\n"
+                         .format(" ".join(f.listings)))
+        if f.tagged:
+            parts.append("{0}: {1}\n\n".format(" ".join(f.products), f.tag))
+        parts.append("\n")
+        return "".join(parts)
+
+    def command(self, f):
+        if self.wrapper is None or not f.command:
+            return f.command
+        return self.wrapper.wrap(f.command, f.inputs, f.outputs, "$(MONK)",
+                                 rulePool(f.rule, self.pools))
+
+    def writeHeader(self, out):
+        if self.wrapper is not None:
+            out.write("MONK ?= {0}\n\n".format(monkCommand(relative=True)))
+        if self.goals:
+            #the goals become the default.
+            out.write("monk-goals: {0}\n\n.PHONY: monk-goals\n\n"
+                      .format(" ".join(self.goals)))
+
+    def write(self, out):
+        self.writeHeader(out)
+        for f in self.entries:
+            out.write(self.rule(f))
+
+    def shards(self):
+        """The entries grouped by the command whose match began each rule,
+        as (command index, entries), in order of first appearance."""
+        groups = {}
+        order = []
+        for f in self.entries:
+            n = f.rule.sources[0][0] if f.rule.sources else -1
+            if not groups.has_key(n):
+                groups[n] = []
+                order.append(n)
+            groups[n].append(f)
+        return [(n, groups[n]) for n in order]
+
+    def writeShards(self, path, directory, regenerate):
+        """Write the rules of each command to its own fragment in a
+        directory, and an index makefile at path that includes them. A
+        fragment is rewritten only if it changed, or if a listing it
+        depends on is newer, so a listing change brings in just the
+        fragments that use it. Returns whether anything was written."""
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        names = []
+        allListings = []
+        wrote = False
+        for (n, entries) in self.shards():
+            name = os.path.join(directory, "{0}.mk".format(n))
+            names.append(name)
+            listings = distinct([l for f in entries for l in f.listings])
+            allListings.extend(listings)
+            stale = [l for l in listings if (mtime(l) or 0) > (mtime(name) or 0)]
+            def write(out, entries=entries):
+                for f in entries:
+                    out.write(self.rule(f))
+            wrote = writeOutput(name, write, changedOnly=not stale) or wrote
+        for old in glob.glob(os.path.join(directory, "*.mk")):
+            if old not in names:
+                os.remove(old)
+        #the stamp is newer than the listings as of the last run.
+        stamp = os.path.join(directory, ".stamp")
+        open(stamp, 'a').close()
+        os.utime(stamp, None)
+        def writeIndex(out):
+            self.writeHeader(out)
+            out.write("MONK_SHARDS := {0}\n\ninclude $(MONK_SHARDS)\n\n"
+                      .format(" ".join(names)))
+            #fragments out of date with their listings, or missing, are
+            #made again by one run of monk, which touches the stamp; so
+            #make -j doesn't start a run for each.
+            out.write("$(MONK_SHARDS): {0} ;\n\n".format(stamp))
+            out.write("{0}: {1} $(if $(filter-out $(wildcard $(MONK_SHARDS)),"
+                      "$(MONK_SHARDS)),.monk-force)\n\t{2}\n\n.monk-force:\n"
+                      .format(stamp, " ".join(distinct(allListings)),
+                              regenerate[1].replace("$", "$$")))
+        return writeOutput(path, writeIndex, changedOnly=True) or wrote
+
+def ninjaPath(path):
+    return path.replace("$", "$$").replace(" ", "$ ").replace(":", "$:")
+
+def ninjaPaths(paths):
+    return " ".join([ninjaPath(p) for p in paths])
 
-    def mkdirCommands(self, tagdir):
-        targets = [word.word for word in self.words if word.mkdir]
-        if (self.isTagged()):
-            targets.extend(self.taggedProducts(tagdir))
-        dirs = [os.path.split(x)[0] for x in targets]
+class NinjaEmitter(object):
+    """Writes a build.ninja for a list of rules. Ninja handles multiple
+    outputs itself, so there are no tag files. Commands are taken as
+    shell text, as --run takes them. If given the command that made it
+    and the files that command reads, the build.ninja regenerates itself
+    when those files (or any listing) change."""
+    def __init__(self, rules, wrapper=None, regenerate=None, goals=None,
+                 pools=None):
+        self.fields = [RuleFields(r, "") for r in rules]
+        self.goals = goals
+        self.pools = pools
+        self.wrapper = wrapper
+        self.regenerate = regenerate
+        self.products = set([p for f in self.fields for p in f.products])
+        #make allows several rules to add to a phony target; ninja doesn't.
+        self.phonies = {}
+        self.phonyOrder = []
+        for f in self.fields:
+            for t in f.phonyTargets:
+                if t not in self.phonies:
+                    self.phonies[t] = []
+                    self.phonyOrder.append(t)
+                self.phonies[t].extend(f.products)
+
+    def edge(self, f):
+        if not f.products:
+            #nothing to name the edge by.
+            return ""
+        if not f.command:
+            return "build {0}: phony {1}\n\n".format(ninjaPaths(f.products),
+                                                      ninjaPaths(f.dependencies))
+        command = f.command
+        if self.wrapper is not None:
+            command = self.wrapper.wrap(command, f.inputs, f.outputs,
+                                        monkCommand(relative=True))
+        #ninja makes the directories of outputs, but not of other words.
+        dirs = distinct([os.path.split(w.word)[0] for w in f.rule.words
+                         if w.mkdir and not w.output
+                         and os.path.split(w.word)[0] != ""])
         if dirs:
-            return ("\t"
-                    + "\n\t".join(["mkdir -p {0}".format(i)
-                                         for i in set(dirs)
-                                         if i != ""])
-                    + "\n")
+            command = "mkdir -p {0} && {1}".format(" ".join(dirs), command)
+        lines = ["build {0}: run {1}".format(ninjaPaths(f.products),
+                                             ninjaPaths(f.dependencies)),
+                 "  cmd = " + command.replace("$", "$$")]
+        if self.wrapper is not None and self.wrapper.hashdb is not None:
+            #a skipped command leaves its outputs alone.
+            lines.append("  restat = 1")
+        pool = rulePool(f.rule, self.pools)
+        if pool is not None:
+            lines.append("  pool = " + pool[0])
+        return "\n".join(lines) + "\n\n"
+
+    def write(self, out):
+        out.write("ninja_required_version = 1.1\n\n"
+                  "rule run\n  command = $cmd\n\n")
+        for (name, size) in sorted(set([p for p in self.pools or [] if p])):
+            out.write("pool {0}\n  depth = {1}\n\n".format(name, size))
+        if self.regenerate is not None:
+            (path, command, inputs) = self.regenerate
+            listings = distinct([l for f in self.fields for l in f.listings])
+            out.write("rule monk\n  command = {0}\n  generator = 1\n"
+                      "  description = regenerating $out\n\n"
+                      .format(command.replace("$", "$$")))
+            out.write("build {0}: monk {1}\n\n".format(
+                ninjaPath(path), ninjaPaths(distinct(inputs + listings))))
+        for f in self.fields:
+            out.write(self.edge(f))
+        for t in self.phonyOrder:
+            if t not in self.products:
+                out.write("build {0}: phony {1}\n\n".format(
+                    ninjaPath(t), ninjaPaths(distinct(self.phonies[t]))))
+        if self.goals:
+            out.write("default {0}\n".format(ninjaPaths(self.goals)))
+
+def regeneration(path, argv, finder=None):
+    """For a generator edge: the path being written, the command that
+    writes it and the files that command reads. Those include the
+    directories the finder scanned, which change when files are added to
+    or removed from them, and the git index if it was read. The directory
+    the output is in is left out: ninja keeps its log there, so it
+    changes on every run."""
+    args = []
+    skip = False
+    for a in argv:
+        #regenerating shouldn't start a watcher.
+        if skip or a == "--watch":
+            skip = False
+        elif a == "--watch-interval":
+            skip = True
+        elif not a.startswith("--watch-interval="):
+            args.append(a)
+    command = " ".join([monkCommand(relative=True)] +
+                       [shellQuote(a) for a in args])
+    inputs = [a[1:] for a in argv if a.startswith("@")]
+    if finder is not None:
+        own = os.path.dirname(path) or os.curdir
+        inputs.extend([d for d in finder.walked
+                       if os.path.normpath(d) != os.path.normpath(own)])
+        if finder.readIndex:
+            inputs.append(os.path.join(".git", "index"))
+    return (path, command, inputs)
+
+def writeOutput(path, write, changedOnly=False):
+    """Call write() with stdout, or with a buffered temporary file that then
+    replaces the file at path. With changedOnly, a file that would come out
+    the same is left alone. Returns whether anything was written."""
+    if path is None or path == "-":
+        write(sys.stdout)
+    else:
+        temp = path + ".tmp"
+        with open(temp, 'w', 1 << 20) as out:
+            write(out)
+        if changedOnly and os.path.isfile(path) and filecmp.cmp(temp, path, False):
+            os.remove(temp)
+            return False
+        os.rename(temp, path)
+    return True
+
+def monkCommand(relative=False):
+    """How to invoke this script from a rule. Relative to the current
+    directory, if asked and if it's underneath it."""
+    script = os.path.abspath(__file__)
+    if script.endswith(".pyc") or script.endswith(".pyo"):
+        script = script[:-1]
+    if relative:
+        path = os.path.relpath(script)
+        if not path.startswith(os.pardir):
+            return shellQuote(os.path.join(os.curdir, path))
+    return " ".join([shellQuote(sys.executable), shellQuote(script)])
+
+class Wrapper(object):
+    """Options for running rule commands through `monk.py exec`."""
+    def __init__(self, hashdb=None, touch=True, artifacts=None, limit=None,
+                 timelog=None, pooldir=None):
+        self.hashdb = hashdb
+        self.touch = touch
+        self.artifacts = artifacts
+        self.limit = limit
+        self.timelog = timelog
+        self.pooldir = pooldir
+
+    def wrap(self, command, inputs, outputs, monk, pool=None):
+        if self.pooldir is None:
+            pool = None
+        if pool is None and self.hashdb is None and self.artifacts is None \
+           and self.timelog is None:
+            #only here for other rules' pools.
+            return command
+        args = [monk, "exec"]
+        if pool is not None:
+            args.extend(["--pool", shellQuote("{0}:{1}".format(*pool)),
+                         "--pooldir", shellQuote(self.pooldir)])
+        if self.hashdb is not None:
+            args.extend(["--hashdb", shellQuote(self.hashdb)])
+            if not self.touch:
+                args.append("--no-touch")
+        if self.artifacts is not None:
+            args.extend(["--artifacts", shellQuote(self.artifacts)])
+            if self.limit is not None:
+                args.extend(["--artifacts-limit", str(self.limit)])
+        if self.timelog is not None:
+            args.extend(["--timelog", shellQuote(self.timelog)])
+        if [x for x in (self.hashdb, self.artifacts, self.timelog) if x is not None]:
+            args.append("--inputs")
+            args.extend([shellQuote(i) for i in inputs])
+            args.append("--outputs")
+            args.extend([shellQuote(o) for o in outputs])
+        args.extend(["--", shellQuote(command)])
+        return " ".join(args)
+
+def makeWrapper(hashed=False, tagdir="tags", touch=True, artifacts=None,
+                artifacts_limit=None, timelog=None, pools=None, pooled=True,
+                **kwargs):
+    """The Wrapper called for by the command line options, or None. With
+    pooled, rules in pools are run through it to hold a slot."""
+    pooldir = None
+    if pooled and pools:
+        pooldir = os.path.join(tagdir, ".pools")
+    if hashed or artifacts or timelog or pooldir:
+        return Wrapper(hashdb=os.path.join(tagdir, ".hashes") if hashed else None,
+                       touch=touch, artifacts=artifacts, limit=artifacts_limit,
+                       timelog=timelog, pooldir=pooldir)
+    return None
+
+def fileDigest(path, known=None):
+    """[mtime, size, sha1] of a file, or None if it doesn't exist. An earlier
+    result is reused if the file's mtime and size haven't changed."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    if known and known[0] == st.st_mtime and known[1] == st.st_size:
+        return known
+    if os.path.isdir(path):
+        return [st.st_mtime, st.st_size, "directory"]
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(1 << 20)
+            if not block:
+                break
+            h.update(block)
+    return [st.st_mtime, st.st_size, h.hexdigest()]
+
+def contentOnly(digests):
+    return dict([(k, v and v[2]) for (k, v) in digests.items()])
+
+class HashDatabase(object):
+    """The digests of each rule's command line, inputs and outputs as of
+    its last successful run. There is one small file per rule, named for
+    its outputs, so that rules running in parallel don't contend."""
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, outputs):
+        key = hashlib.sha1(toBytes("\n".join(sorted(outputs)))).hexdigest()
+        return os.path.join(self.directory, key[:2], key)
+
+    def load(self, outputs):
+        try:
+            with open(self.path(outputs)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def save(self, outputs, record):
+        path = self.path(outputs)
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                #another rule got there first.
+                pass
+        temp = "{0}.{1}.tmp".format(path, os.getpid())
+        with open(temp, 'w') as f:
+            json.dump(record, f)
+        os.rename(temp, path)
+
+def maxrssKB(usage=None):
+    """The peak memory in a resource usage (by default, this process's so
+    far), in kilobytes."""
+    if usage is None:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+    if sys.platform == "darwin":
+        #bytes there, kilobytes elsewhere.
+        return usage.ru_maxrss // 1024
+    return usage.ru_maxrss
+
+def runShell(command):
+    status = subprocess.call(command, shell=True)
+    return 128 - status if status < 0 else status
+
+def acquireSlot(directory, name, size):
+    """Take one of a pool's `size` slots, each a lock file, waiting while
+    they're all taken. The slot is held until the returned file is closed,
+    or this process exits."""
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            #another rule got there first.
+            pass
+    delay = 0.05
+    while True:
+        for n in range(size):
+            f = open(os.path.join(directory, "{0}.{1}".format(name, n)), 'a')
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return f
+            except (IOError, OSError):
+                f.close()
+        time.sleep(delay)
+        delay = min(2 * delay, 0.25)
+
+def runTimed(command, outputs, log):
+    """Run a command, appending to a log a line of JSON with when it
+    started and ended, its exit status, and the CPU time and peak memory
+    of it and the processes it waited for."""
+    started = time.time()
+    p = subprocess.Popen(command, shell=True)
+    while True:
+        try:
+            (pid, status, usage) = os.wait4(p.pid, 0)
+            break
+        except OSError as e:
+            if e.errno != errno.EINTR:
+                raise
+    ended = time.time()
+    p.returncode = status
+    if os.WIFEXITED(status):
+        status = os.WEXITSTATUS(status)
+    else:
+        status = 128 + os.WTERMSIG(status)
+    record = {"outputs": outputs, "command": command, "start": started,
+              "end": ended, "status": status, "user": usage.ru_utime,
+              "system": usage.ru_stime, "maxrssKB": maxrssKB(usage)}
+    try:
+        directory = os.path.dirname(log)
+        if directory and not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                #another rule got there first.
+                pass
+        with open(log, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.write(json.dumps(record, sort_keys=True) + "\n")
+    except (IOError, OSError) as e:
+        #a missing timing shouldn't fail the build.
+        print("monk: warning: can't write to {0}: {1}".format(log, e.strerror),
+              file=sys.stderr)
+    return status
+
+def parseSize(size):
+    """A number of bytes, with an optional K, M, G or T suffix."""
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+    size = str(size).strip().upper().rstrip("B")
+    if size[-1:] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+class ArtifactCache(object):
+    """Outputs of earlier runs, kept under a digest of the command line,
+    the inputs' names and contents and the outputs' names, so that any
+    checkout sharing the directory can restore them instead of running
+    the command again.
+
+    Each entry is a directory holding read-only copies of the outputs and
+    a manifest; the manifest's mtime is when the entry was last used, and
+    once the cache grows past `limit` bytes the least recently used
+    entries are removed. Counts of hits, misses and so on are kept in
+    stats.json."""
+    def __init__(self, directory, limit=None):
+        self.directory = directory
+        self.limit = limit
+
+    def key(self, command, inputs, outputs):
+        digests = [(i, (fileDigest(i) or [None] * 3)[2]) for i in inputs]
+        desc = json.dumps([command, digests, outputs])
+        return hashlib.sha1(toBytes(desc)).hexdigest()
+
+    def entry(self, key):
+        return os.path.join(self.directory, "objects", key[:2], key)
+
+    def restore(self, key, outputs):
+        """Put copies of the outputs stored under key in place. (Hard
+        links would leave them read-only, and a command writing to one
+        in place would change the stored copy.) Returns whether there
+        were any."""
+        entry = self.entry(key)
+        manifest = os.path.join(entry, "manifest.json")
+        try:
+            with open(manifest) as f:
+                record = json.load(f)
+            if record["outputs"] != outputs:
+                raise ValueError("not the same outputs")
+            for (n, o) in enumerate(outputs):
+                directory = os.path.dirname(o)
+                if directory and not os.path.isdir(directory):
+                    os.makedirs(directory)
+                if os.path.lexists(o):
+                    os.remove(o)
+                #not copy2, which would copy the read-only mode.
+                shutil.copyfile(os.path.join(entry, str(n)), o)
+            os.utime(manifest, None)
+        except (IOError, OSError, ValueError, KeyError):
+            #missing, or evicted while we were restoring it.
+            self.count(misses=1)
+            return False
+        self.count(hits=1, restoredBytes=record["size"])
+        return True
+
+    def store(self, key, outputs):
+        """Copy the outputs into the cache under key."""
+        if [o for o in outputs if not os.path.isfile(o)] or not outputs:
+            return
+        entry = self.entry(key)
+        if os.path.isdir(entry):
+            return
+        temp = os.path.join(self.directory, "tmp",
+                            "{0}.{1}".format(key, os.getpid()))
+        try:
+            os.makedirs(temp)
+            size = 0
+            for (n, o) in enumerate(outputs):
+                stored = os.path.join(temp, str(n))
+                shutil.copy2(o, stored)
+                os.chmod(stored, 0o444)
+                size = size + os.path.getsize(stored)
+            with open(os.path.join(temp, "manifest.json"), 'w') as f:
+                json.dump({"outputs": outputs, "size": size}, f)
+            if not os.path.isdir(os.path.dirname(entry)):
+                os.makedirs(os.path.dirname(entry))
+            os.rename(temp, entry)
+        except (IOError, OSError):
+            #full, or another run stored the same thing first.
+            shutil.rmtree(temp, ignore_errors=True)
+            return
+        self.count(stores=1, storedBytes=size)
+        if self.limit is not None:
+            self.evict(self.limit)
+
+    def entries(self):
+        """(last used, size, directory) for each entry."""
+        found = []
+        objects = os.path.join(self.directory, "objects")
+        for manifest in glob.glob(os.path.join(objects, "*", "*", "manifest.json")):
+            try:
+                with open(manifest) as f:
+                    size = json.load(f)["size"]
+                found.append((os.stat(manifest).st_mtime, size,
+                              os.path.dirname(manifest)))
+            except (IOError, OSError, ValueError, KeyError):
+                pass
+        return found
+
+    def evict(self, limit):
+        """Remove the least recently used entries until the rest take at
+        most limit bytes. Returns how many were removed."""
+        found = sorted(self.entries())
+        total = sum([size for (used, size, entry) in found])
+        removed = 0
+        for (used, size, entry) in found:
+            if total <= limit:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total = total - size
+            removed = removed + 1
+        if removed:
+            self.count(evictions=removed)
+        return removed
+
+    def stats(self):
+        try:
+            with open(os.path.join(self.directory, "stats.json")) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def count(self, **counts):
+        path = os.path.join(self.directory, "stats.json")
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            with open(path + ".lock", 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                stats = self.stats()
+                for (k, v) in counts.items():
+                    stats[k] = stats.get(k, 0) + v
+                temp = "{0}.{1}.tmp".format(path, os.getpid())
+                with open(temp, 'w') as f:
+                    json.dump(stats, f, sort_keys=True)
+                os.rename(temp, path)
+        except (IOError, OSError):
+            pass
+
+def runCached(command, inputs, outputs, cache, shell=runShell):
+    """Restore a command's outputs from the artifact cache, or run it and
+    store them."""
+    key = cache.key(command, inputs, outputs)
+    if cache.restore(key, outputs):
+        print("monk: restored {0} from {1}".format(" ".join(outputs),
+                                                  cache.directory),
+              file=sys.stderr)
+        return 0
+    status = shell(command)
+    if status == 0:
+        cache.store(key, outputs)
+    return status
+
+def runHashed(command, inputs, outputs, db, touch=True, run=runShell):
+    """Run a command, unless its command line and the contents of its inputs
+    are as they were when it last succeeded and its outputs haven't
+    changed since. A skipped command's outputs are touched, so make sees
+    them as up to date; since unchanged outputs keep their digests, rules
+    downstream of a rebuild that changed nothing are skipped in turn.
+    (Ninja's restat does without the touching.)"""
+    record = db.load(outputs) or {}
+    commandDigest = hashlib.sha1(toBytes(command)).hexdigest()
+    known = record.get("inputs", {})
+    current = dict([(i, fileDigest(i, known.get(i))) for i in inputs])
+    if (record.get("command") == commandDigest
+        and contentOnly(current) == contentOnly(known)):
+        known = record.get("outputs", {})
+        products = dict([(o, fileDigest(o, known.get(o))) for o in outputs])
+        if (None not in products.values()
+            and contentOnly(products) == contentOnly(known)):
+            if touch:
+                for o in outputs:
+                    os.utime(o, None)
+            record["inputs"] = current
+            record["outputs"] = dict([(o, fileDigest(o)) for o in outputs])
+            db.save(outputs, record)
+            return 0
+    status = run(command)
+    if status == 0:
+        db.save(outputs, {"command": commandDigest,
+                          "inputs": current,
+                          "outputs": dict([(o, fileDigest(o)) for o in outputs])})
+    return status
+
+def memberStale(member):
+    """Whether a rule in a batch manifest needs running."""
+    times = [mtime(o) for o in member["outputs"]]
+    if None in times:
+        return True
+    inputs = [mtime(i) for i in member["inputs"]]
+    if None in inputs:
+        return True
+    return bool(inputs) and bool(times) and max(inputs) > min(times)
+
+def batchMain(argv):
+    """monk.py batch: run a --batch command on the rules in its batch that
+    are out of date."""
+    parser = argparse.ArgumentParser(prog="monk.py batch",
+                                     description="Run a batched command.")
+    parser.add_argument('manifest',
+                        help="The manifest written with the rules.")
+    parser.add_argument('command', nargs=argparse.REMAINDER,
+                        help="The command, after '--'. The name of a file "
+                        "listing the out of date rules is added to it.")
+    args = parser.parse_args(argv)
+    command = args.command
+    if command[:1] == ["--"]:
+        command = command[1:]
+    with open(args.manifest) as f:
+        members = json.load(f)["members"]
+    stale = [m for m in members if memberStale(m)]
+    if not stale:
+        return 0
+    todo = args.manifest + ".todo"
+    with open(todo, 'w') as f:
+        for m in stale:
+            print("\t".join(m["words"]), file=f)
+    return runShell(" ".join(command + [shellQuote(todo)]))
+
+##Dependency scanners, standing in for autodep/locate_deps.R and fdep.m.
+
+rTokens = re.compile(r"""(\#[^\n]*)|("(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')"""
+                     r"""|(`[^`]*`|[A-Za-z.][A-Za-z0-9._]*)|(%[^%\n]*%|\S)""")
+
+def tokenizeR(text):
+    """(kind, text) for each token of R source, kind being "string",
+    "name" or "op"; comments are dropped."""
+    tokens = []
+    for (comment, string, name, op) in rTokens.findall(text):
+        if string:
+            quote = string[0]
+            tokens.append(("string", string[1:-1].replace("\\" + quote, quote)))
+        elif name:
+            tokens.append(("name", name.strip("`")))
+        elif op:
+            tokens.append(("op", op))
+    return tokens
+
+def scanR(text):
+    """The packages an R script loads with library() or require(), and
+    the files it reads with source() or load(), as locate_deps.R finds
+    them."""
+    tokens = tokenizeR(text) + [("op", "")] * 4
+    packages = []
+    sources = []
+    for (n, (kind, word)) in enumerate(tokens[:-4]):
+        if kind != "name" or tokens[n + 1] != ("op", "("):
+            continue
+        arg = n + 2
+        if word in ("library", "require"):
+            if tokens[arg] == ("name", "package") and tokens[arg + 1] == ("op", "="):
+                arg = arg + 2
+            elif tokens[arg + 1] == ("op", "="):
+                #some other argument by name.
+                continue
+            if tokens[arg][0] in ("string", "name"):
+                packages.append(tokens[arg][1])
+        elif word in ("source", "load"):
+            if tokens[arg] == ("name", "file") and tokens[arg + 1] == ("op", "="):
+                arg = arg + 2
+            if tokens[arg][0] == "string":
+                sources.append(tokens[arg][1])
+    return {"packages": distinct(packages), "sources": distinct(sources)}
+
+matlabKeywords = set(["break", "case", "catch", "classdef", "continue", "else",
+                      "elseif", "end", "for", "function", "global", "if",
+                      "otherwise", "parfor", "persistent", "return", "spmd",
+                      "switch", "try", "while", "methods", "properties",
+                      "events", "enumeration"])
+
+mTokens = re.compile(r"""('(?:[^'\n]|'')*'|"(?:[^"\n]|"")*")|([A-Za-z][A-Za-z0-9_]*)"""
+                     r"""|([0-9]+(?:\.[0-9]*)?(?:[eE][-+]?[0-9]+)?[ij]?)|(\S)""")
+
+def codeLines(text):
+    """The lines of MATLAB source, less comments, block comments and
+    continuations."""
+    lines = []
+    block = 0
+    for line in text.splitlines():
+        if line.strip() == "%{":
+            block = block + 1
+        elif line.strip() == "%}" and block:
+            block = block - 1
+        elif not block:
+            lines.append(line)
+    return lines
+
+def scanM(text):
+    """The names a MATLAB file uses that might be functions: identifiers
+    that aren't keywords, fields, or variables and functions of its own."""
+    names = []
+    own = set()
+    for line in codeLines(text):
+        tokens = []
+        previous = None
+        for m in mTokens.finditer(line):
+            (string, name, number, op) = m.groups()
+            if string and string[0] == "'" and previous is not None and \
+               (previous[0] in ("name", "number") or previous[1] in ")]}'."):
+                #a transpose, not a string.
+                tokens.append(("op", "'"))
+                tokens.extend([("name", x) for x in re.findall(
+                    "[A-Za-z][A-Za-z0-9_]*", string[1:])])
+            elif string:
+                tokens.append(("string", string))
+            elif name:
+                tokens.append(("name", name))
+            elif number:
+                tokens.append(("number", number))
+            elif op == "%":
+                break
+            elif op == "." and line[m.end():m.end() + 2] == "..":
+                break
+            else:
+                tokens.append(("op", op))
+            previous = tokens[-1]
+        header = re.match(r"\s*function\s+(?:(\[[^\]]*\]|\w+)\s*=\s*)?(\w+)"
+                          r"(?:\s*\(([^)]*)\))?", line)
+        if header:
+            own.add(header.group(2))
+            own.update(re.findall(r"\w+", (header.group(1) or "") + " " +
+                                  (header.group(3) or "")))
+        assigned = re.match(r"\s*(?:\[([^\]=]*)\]|(\w+))\s*=(?!=)", line)
+        if assigned:
+            own.update(re.findall(r"\w+", assigned.group(1) or assigned.group(2)))
+        for (n, (kind, word)) in enumerate(tokens):
+            if kind == "name" and word not in matlabKeywords and \
+               (n == 0 or tokens[n - 1] != ("op", ".")):
+                names.append(word)
+    return {"names": distinct([x for x in names if x not in own])}
+
+scannerVersion = 1
+
+class ScanCache(object):
+    """The results of scanning files, kept in a directory under a digest
+    of each file's contents, so a file is only scanned once."""
+    def __init__(self, directory, scanners):
+        self.directory = directory
+        self.scanners = scanners
+
+    def scan(self, kind, path):
+        with open(path, 'rb') as f:
+            content = f.read()
+        key = hashlib.sha1(toBytes(repr((scannerVersion, kind))) + content).hexdigest()
+        cached = os.path.join(self.directory, key[:2], key + ".json")
+        try:
+            with open(cached) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            pass
+        result = self.scanners[kind](content.decode("utf-8", "replace"))
+        try:
+            if not os.path.isdir(os.path.dirname(cached)):
+                os.makedirs(os.path.dirname(cached))
+            temp = "{0}.{1}.tmp".format(cached, os.getpid())
+            with open(temp, 'w') as f:
+                json.dump(result, f)
+            os.rename(temp, cached)
+        except (IOError, OSError):
+            pass
+        return result
+
+def projectPath(path):
+    """A path relative to the current directory if it's underneath it."""
+    relative = os.path.relpath(path)
+    return path if relative.startswith(os.pardir) else relative
+
+def findFunction(name, directory, path):
+    """The M-file MATLAB would run for a name, looking in the calling
+    file's private directory and directory, then along the path."""
+    for d in [os.path.join(directory, "private"), directory] + path:
+        for candidate in (os.path.join(d, name + ".m"),
+                          os.path.join(d, "@" + name, name + ".m")):
+            if os.path.isfile(candidate):
+                return projectPath(os.path.normpath(candidate))
+    return None
+
+def mDependencies(mfile, cache, path):
+    """The M-files an M-file uses, and those they use in turn, as fdep.m
+    finds them (less MATLAB's own)."""
+    start = projectPath(os.path.normpath(mfile))
+    seen = set([start])
+    found = []
+    queue = [start]
+    while queue:
+        f = queue.pop(0)
+        directory = os.path.dirname(f) or os.curdir
+        for name in cache.scan("m", f)["names"]:
+            d = findFunction(name, directory, path)
+            if d is not None and d not in seen:
+                seen.add(d)
+                found.append(d)
+                queue.append(d)
+    return found
+
+def writeLines(path, lines):
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(path, 'w') as f:
+        for line in lines:
+            print(line, file=f)
+
+def scanDeps(kind, args, cache, path):
+    if kind == "r":
+        (rfile, pkgfile, depfile) = args
+        result = cache.scan("r", rfile)
+        directory = os.path.dirname(rfile)
+        writeLines(pkgfile, result["packages"])
+        #sourced files are relative to the script, like locate_deps.R.
+        writeLines(depfile, [os.path.join(directory, x) for x in result["sources"]])
+    else:
+        (mfile, depfile) = args
+        writeLines(depfile, mDependencies(mfile, cache, path))
+
+def scanDepsMain(argv):
+    """monk.py scan-deps: find the packages and files an R script uses, or
+    the functions an M-file uses, without starting R or MATLAB."""
+    parser = argparse.ArgumentParser(
+        prog="monk.py scan-deps",
+        description="Write the dependency listings autodep uses: for R, a "
+        ".pkg file of the packages loaded by library() or require() and a "
+        ".dep file of the files read by source() or load(); for MATLAB, a "
+        ".dep file of the M-files of the functions used, found in the "
+        "file's directory, the current directory and --path.")
+    parser.add_argument('kind', choices=["r", "m"])
+    parser.add_argument('files', nargs='*', metavar="FILE",
+                        help="For r, the script, the .pkg file and the .dep "
+                        "file; for m, the M-file and the .dep file. A single "
+                        "FILE is taken as a manifest, as --batch gives one.")
+    parser.add_argument('--manifest',
+                        help="A file with the FILE arguments of a scan on "
+                        "each line, separated by tabs (as written by "
+                        "--batch).")
+    parser.add_argument('--cache', default=os.path.join("tags", ".depscan"),
+                        help="Where to keep the results of scanning each "
+                        "file's contents. (default tags/.depscan)")
+    parser.add_argument('--path', action='append', default=[],
+                        help="Another directory to look for M-files in. "
+                        "(May be given more than once.)")
+    args = parser.parse_args(argv)
+    cache = ScanCache(args.cache, {"r": scanR, "m": scanM})
+    path = [os.curdir] + args.path
+    scans = []
+    manifests = [args.manifest] if args.manifest is not None else []
+    if len(args.files) == 1:
+        #no scan takes a single file, so it's the manifest of a batch.
+        manifests.append(args.files[0])
+    elif args.files:
+        scans.append(args.files)
+    for manifest in manifests:
+        with open(manifest) as f:
+            scans.extend([line.split("\t") for line in f.read().splitlines()
+                          if line])
+    width = 3 if args.kind == "r" else 2
+    for scan in scans:
+        if len(scan) != width:
+            parser.error("expected {0} files for {1}, not {2}"
+                         .format(width, args.kind, " ".join(scan)))
+        scanDeps(args.kind, scan, cache, path)
+    return 0
+
+def execMain(argv):
+    """monk.py exec: run a rule's command on behalf of a generated Makefile
+    or the executor."""
+    parser = argparse.ArgumentParser(prog="monk.py exec",
+                                     description="Run one rule's command.")
+    parser.add_argument('--hashdb',
+                        help="Skip the command if its command line and the "
+                        "contents of its inputs and outputs are unchanged "
+                        "since it last succeeded, according to the hash "
+                        "database in this directory.")
+    parser.add_argument('--inputs', nargs='*', default=[],
+                        help="The files the command reads.")
+    parser.add_argument('--no-touch', dest="touch", action='store_false',
+                        help="When skipping the command, leave the outputs' "
+                        "modification times alone.")
+    parser.add_argument('--outputs', nargs='*', default=[],
+                        help="The files the command writes.")
+    parser.add_argument('--artifacts', metavar="DIR",
+                        help="Restore the outputs from this artifact cache "
+                        "if the same command has run on the same inputs, "
+                        "and store them there if not.")
+    parser.add_argument('--artifacts-limit', type=parseSize, metavar="SIZE",
+                        help="Evict the least recently used artifacts to "
+                        "keep the cache under this size.")
+    parser.add_argument('--timelog', metavar="FILE",
+                        help="Append the command's start and end times, exit "
+                        "status, CPU time and peak memory to this file, if "
+                        "it runs.")
+    parser.add_argument('--pool', metavar="NAME:SIZE",
+                        help="Wait for one of the SIZE slots of this pool "
+                        "before running the command.")
+    parser.add_argument('--pooldir', default="tags/.pools",
+                        help="Where the pools' lock files are. (default "
+                        "tags/.pools)")
+    parser.add_argument('command', nargs=argparse.REMAINDER,
+                        help="The command, after '--'.")
+    args = parser.parse_args(argv)
+    command = args.command
+    if command[:1] == ["--"]:
+        command = command[1:]
+    command = " ".join(command)
+    slot = None
+    if args.pool is not None:
+        (name, size) = args.pool.rsplit(":", 1)
+        #the pool's lock is held for as long as the slot's file is open.
+        slot = acquireSlot(args.pooldir, name, int(size))
+    try:
+        shell = runShell
+        if args.timelog is not None:
+            shell = lambda c: runTimed(c, args.outputs, args.timelog)
+        run = shell
+        if args.artifacts is not None:
+            cache = ArtifactCache(args.artifacts, args.artifacts_limit)
+            run = lambda c: runCached(c, args.inputs, args.outputs, cache, shell)
+        if args.hashdb is not None:
+            return runHashed(command, args.inputs, args.outputs,
+                             HashDatabase(args.hashdb), args.touch, run)
+        return run(command)
+    finally:
+        if slot is not None:
+            slot.close()
+
+def artifactsMain(argv):
+    """monk.py artifacts: report on an artifact cache, or trim it."""
+    parser = argparse.ArgumentParser(prog="monk.py artifacts",
+                                     description="Show the statistics of an "
+                                     "artifact cache (see --artifacts).")
+    parser.add_argument('directory', help="The artifact cache.")
+    parser.add_argument('--evict', type=parseSize, metavar="SIZE",
+                        help="First remove the least recently used entries "
+                        "until the cache takes at most SIZE bytes.")
+    args = parser.parse_args(argv)
+    cache = ArtifactCache(args.directory)
+    if args.evict is not None:
+        cache.evict(args.evict)
+    stats = cache.stats()
+    found = cache.entries()
+    stats["entries"] = len(found)
+    stats["bytes"] = sum([size for (used, size, entry) in found])
+    lookups = stats.get("hits", 0) + stats.get("misses", 0)
+    if lookups:
+        stats["hitRate"] = round(float(stats.get("hits", 0)) / lookups, 3)
+    for k in sorted(stats):
+        print("{0}: {1}".format(k, stats[k]))
+    return 0
+
+class Connection(object):
+    """A socket carrying one JSON message per line, between the executor
+    and a worker."""
+    def __init__(self, sock, name):
+        self.sock = sock
+        self.name = name
+        self.buffer = b""
+        #the (job, command) the worker is running, if any.
+        self.job = None
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def send(self, message):
+        self.sock.sendall(toBytes(json.dumps(message) + "\n"))
+
+    def receive(self):
+        """Read what has arrived. Returns the messages it completes, or
+        None if the other end has gone."""
+        try:
+            data = self.sock.recv(1 << 16)
+        except socket.error:
+            return None
+        if not data:
+            return None
+        self.buffer += data
+        lines = self.buffer.split(b"\n")
+        self.buffer = lines.pop()
+        return [json.loads(l.decode("utf-8")) for l in lines]
+
+    def read(self):
+        """Wait for the next message; None if the other end has gone."""
+        while b"\n" not in self.buffer:
+            try:
+                data = self.sock.recv(1 << 16)
+            except socket.error:
+                return None
+            if not data:
+                return None
+            self.buffer += data
+        (line, self.buffer) = self.buffer.split(b"\n", 1)
+        return json.loads(line.decode("utf-8"))
+
+    def close(self):
+        self.sock.close()
+
+def splitAddress(address):
+    (host, port) = address.rsplit(":", 1)
+    return (host, int(port))
+
+def workerToken(path=None):
+    """The secret a worker and the executors sending it commands share:
+    the contents of a file, or else $MONK_WORKER_TOKEN."""
+    if path is not None:
+        with open(path) as f:
+            return f.read().strip() or None
+    return os.environ.get("MONK_WORKER_TOKEN") or None
+
+def isLoopback(host):
+    try:
+        return socket.gethostbyname(host).startswith("127.")
+    except socket.error:
+        return False
+
+def runRequest(request):
+    """Run a command sent to a worker. The reply has its exit status and
+    output, and the modification time and size of each output it made."""
+    directory = request["directory"]
+    for d in request["dirs"]:
+        d = os.path.join(directory, d)
+        if not os.path.isdir(d):
+            os.makedirs(d)
+    p = subprocess.Popen(request["command"], shell=True, cwd=directory,
+                         stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = p.communicate()[0]
+    status = p.returncode
+    outputs = {}
+    for o in request["outputs"]:
+        try:
+            st = os.stat(os.path.join(directory, o))
+            outputs[o] = [st.st_mtime, st.st_size]
+        except OSError:
+            outputs[o] = None
+    return {"status": 128 - status if status < 0 else status,
+            "output": output.decode("utf-8", "replace"),
+            "outputs": outputs}
+
+def workerMain(argv):
+    """monk.py worker: run the commands sent by `monk.py --run --worker`,
+    one at a time."""
+    parser = argparse.ArgumentParser(prog="monk.py worker",
+                                     description="Run rule commands for "
+                                     "monk.py --run --worker. Anyone who can "
+                                     "connect to a worker can run any command "
+                                     "as its user, so connections must give "
+                                     "the token in --token-file or "
+                                     "$MONK_WORKER_TOKEN. Without a token, "
+                                     "only loopback addresses are allowed.")
+    parser.add_argument('--listen', default="127.0.0.1:0", metavar="HOST:PORT",
+                        help="The address to take connections on. Port 0 "
+                        "picks a free port; the address is printed on "
+                        "stdout. (default 127.0.0.1:0)")
+    parser.add_argument('--token-file', metavar="FILE",
+                        help="A file holding the token executors must give "
+                        "(as with monk.py --worker-token-file). (default "
+                        "$MONK_WORKER_TOKEN)")
+    parser.add_argument('--insecure', action='store_true',
+                        help="Listen on an address other machines can reach "
+                        "without a token, letting anyone who can reach it "
+                        "run commands.")
+    args = parser.parse_args(argv)
+    token = workerToken(args.token_file)
+    if (token is None and not args.insecure and
+        not isLoopback(splitAddress(args.listen)[0])):
+        parser.error("listening on {0} needs a token (--token-file or "
+                     "$MONK_WORKER_TOKEN), or --insecure".format(args.listen))
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(splitAddress(args.listen))
+    server.listen(1)
+    print("listening on {0}:{1}".format(*server.getsockname()))
+    sys.stdout.flush()
+    while True:
+        (sock, address) = server.accept()
+        connection = Connection(sock, "{0}:{1}".format(*address))
+        try:
+            #each connection starts by giving the token.
+            hello = connection.read()
+            if hello is None:
+                pass
+            elif token is not None and not hmac.compare_digest(
+                    toBytes(hello.get("token") or ""), toBytes(token)):
+                print("monk: refused {0}: wrong token".format(connection.name),
+                      file=sys.stderr)
+                connection.send({"error": "wrong token"})
+            else:
+                connection.send({"ok": True})
+                while True:
+                    request = connection.read()
+                    if request is None:
+                        break
+                    connection.send(runRequest(request))
+        except socket.error:
+            #the executor went away mid-reply; wait for the next one.
+            pass
+        finally:
+            connection.close()
+
+##Long-lived R and MATLAB processes for rules' scripts to run in, instead
+##of each starting an interpreter of its own.
+
+interpreters = {"r": ["R", "--slave", "--no-save", "--no-restore"],
+                "matlab": ["matlab", "-nodesktop", "-nosplash"]}
+
+def interpSocket(kind):
+    return os.path.join("tags", ".interp-{0}.sock".format(kind))
+
+def rString(s):
+    return '"' + s.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+
+def jobMarkers(job):
+    """The lines an interpreter prints on both streams before and after a
+    job, so that output outside them (a late prompt, say) is dropped."""
+    return ("monk-job-start-" + job, "monk-job-done-" + job)
+
+def rJob(request, job):
+    """R code to run a script as Rscript would, with commandArgs() giving
+    its arguments, between the job's markers, with its exit status."""
+    (start, sentinel) = jobMarkers(job)
+    script = rString(request["script"])
+    args = "c({0})".format(", ".join([rString(a) for a in request["args"]]))
+    return "\n".join([
+        "local({",
+        "  cat(\"" + start + "\\n\")",
+        "  message(\"" + start + "\")",
+        "  .args <- as.character(" + args + ")",
+        "  .status <- 0L",
+        "  .env <- new.env(parent = globalenv())",
+        "  .env$commandArgs <- function(trailingOnly = FALSE)",
+        "    if (trailingOnly) .args else",
+        "    c(\"R\", \"--slave\", \"--no-restore\",",
+        "      paste0(\"--file=\", " + script + "),",
+        "      \"--args\", .args)",
+        "  tryCatch({",
+        "    setwd(" + rString(request["cwd"]) + ")",
+        "    source(" + script + ", local = .env, print.eval = TRUE)",
+        "  }, error = function(e) {",
+        "    message(\"Error: \", conditionMessage(e))",
+        "    .status <<- 1L",
+        "  })",
+        "  cat(\"" + sentinel + "\", .status, \"\\n\")",
+        "  message(\"" + sentinel + "\")",
+        "})", ""])
+
+def matlabJob(request, job):
+    """MATLAB code to run a command as autodep/runmatlab would, between
+    the job's markers, with its exit status."""
+    (start, sentinel) = jobMarkers(job)
+    quote = lambda s: s.replace("'", "''")
+    script = request["script"]
+    name = os.path.splitext(os.path.basename(script))[0]
+    runmatlab = os.path.join(os.path.dirname(os.path.abspath(__file__)), "autodep")
+    command = quote(" ".join([name] + request["args"]))
+    return "\n".join([
+        "clear variables;",
+        "fprintf(1, '{0}\\n');".format(start),
+        "fprintf(2, '{0}\\n');".format(start),
+        "try",
+        "  feature('HotLinks', 'off');",
+        "  addpath('{0}');".format(quote(runmatlab)),
+        "  addpath('{0}');".format(quote(os.path.dirname(os.path.abspath(script)))),
+        "  cd('{0}');".format(quote(request["cwd"])),
+        "  eval('{0}');".format(quote(command)),
+        "  monk_status__ = 0;",
+        "catch monk_error__",
+        "  fprintf(2, '%s', getReport(monk_error__));",
+        "  monk_status__ = 1;",
+        "end",
+        "fprintf(1, '{0} %d\\n', monk_status__);".format(sentinel),
+        "fprintf(2, '{0}\\n');".format(sentinel), ""])
+
+jobWriters = {"r": rJob, "matlab": matlabJob}
+
+class Interpreter(object):
+    """One of the server's interpreters, and the job it's running."""
+    def __init__(self, command):
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.PIPE)
+        self.jobs = 0
+        self.client = None
+        self.begin = None
+        self.sentinel = None
+        self.buffers = {}
+        self.states = {}
+        self.status = None
+
+    def streams(self):
+        return [(self.process.stdout, "out"), (self.process.stderr, "err")]
+
+    def start(self, client, code, job):
+        (start, sentinel) = jobMarkers(job)
+        self.client = client
+        self.begin = toBytes(start + "\n")
+        self.sentinel = toBytes(sentinel)
+        self.buffers = {"out": b"", "err": b""}
+        self.states = {"out": "waiting", "err": "waiting"}
+        self.status = None
+        self.process.stdin.write(toBytes(code))
+        self.process.stdin.flush()
+
+    def forward(self, stream, data):
+        """Pass output on to the client, between the start marker and the
+        sentinel. Returns whether the job is over."""
+        if self.states[stream] == "done":
+            #late output, after the sentinel; it isn't this job's.
+            return False
+        buffered = self.buffers[stream] + data
+        if self.states[stream] == "waiting":
+            #drop what's left over from before the job.
+            begin = buffered.find(self.begin)
+            if begin < 0:
+                self.buffers[stream] = buffered[-(len(self.begin) - 1):]
+                return False
+            self.states[stream] = "running"
+            buffered = buffered[begin + len(self.begin):]
+        end = buffered.find(self.sentinel)
+        if end < 0:
+            #hold back what might be the start of the sentinel.
+            keep = len(self.sentinel) - 1
+            self.send(stream, buffered[:-keep])
+            self.buffers[stream] = buffered[-keep:]
+            return False
+        self.send(stream, buffered[:end])
+        rest = buffered[end + len(self.sentinel):]
+        if stream == "out":
+            if b"\n" not in rest:
+                #wait for the rest of the status line.
+                self.buffers[stream] = buffered[end:]
+                return False
+            self.status = int(rest.split(b"\n")[0].strip() or 1)
+        self.buffers[stream] = b""
+        self.states[stream] = "done"
+        return self.states["out"] == self.states["err"] == "done"
+
+    def send(self, stream, data):
+        if self.client is not None and data:
+            try:
+                self.client.send({stream: data.decode("utf-8", "replace")})
+            except socket.error:
+                #the client has gone; finish the job anyway.
+                self.client = None
+
+    def finish(self, status):
+        if self.client is not None:
+            try:
+                self.client.send({"status": status})
+            except socket.error:
+                pass
+            self.client.close()
+        self.client = None
+        self.sentinel = None
+        self.jobs = self.jobs + 1
+
+    def stop(self):
+        try:
+            self.process.stdin.close()
+        except (IOError, OSError):
+            pass
+        for n in range(50):
+            if self.process.poll() is not None:
+                return
+            time.sleep(0.1)
+        self.process.kill()
+        self.process.wait()
+
+def interpServerMain(argv):
+    """monk.py interp-server: keep a pool of R or MATLAB processes running
+    the scripts sent by `monk.py interp`."""
+    parser = argparse.ArgumentParser(
+        prog="monk.py interp-server",
+        description="Run a pool of long-lived R or MATLAB processes, which "
+        "run the scripts sent by `monk.py interp` one at a time each.")
+    parser.add_argument('kind', choices=sorted(interpreters))
+    parser.add_argument('--socket',
+                        help="The socket to listen on. (default "
+                        "tags/.interp-KIND.sock)")
+    parser.add_argument('--size', type=int, default=2,
+                        help="How many interpreters to keep. (default 2)")
+    parser.add_argument('--recycle', type=int, default=50, metavar="N",
+                        help="Start a fresh interpreter after one has run N "
+                        "jobs, so that what scripts leave behind doesn't "
+                        "build up. 0 means never. (default 50)")
+    parser.add_argument('--interpreter', metavar="COMMAND",
+                        help="The command that starts an interpreter. "
+                        "(default: {0})".format("; ".join(
+                            ["{0} for {1}".format(" ".join(c), k)
+                             for (k, c) in sorted(interpreters.items())])))
+    args = parser.parse_args(argv)
+    command = interpreters[args.kind]
+    if args.interpreter is not None:
+        command = shlex.split(args.interpreter)
+    path = args.socket or interpSocket(args.kind)
+    if os.path.dirname(path) and not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    if os.path.exists(path):
+        os.remove(path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(16)
+    pool = [Interpreter(command) for n in range(args.size)]
+    waiting = []
+    queue = []
+    try:
+        while True:
+            for (n, w) in enumerate(pool):
+                if w.client is None and args.recycle and w.jobs >= args.recycle:
+                    w.stop()
+                    pool[n] = w = Interpreter(command)
+                if w.client is None and w.sentinel is None and queue:
+                    (client, request) = queue.pop(0)
+                    job = hashlib.sha1(toBytes(repr((time.time(), os.getpid(), n)))
+                                       ).hexdigest()
+                    try:
+                        w.start(client, jobWriters[args.kind](request, job), job)
+                    except (IOError, OSError):
+                        #it died while idle.
+                        queue.insert(0, (client, request))
+                        pool[n] = Interpreter(command)
+            streams = dict([(f, (w, name)) for w in pool if w.sentinel is not None
+                            for (f, name) in w.streams()])
+            readable = select.select([server] + waiting + list(streams), [], [])[0]
+            for r in readable:
+                if r is server:
+                    (sock, address) = server.accept()
+                    waiting.append(Connection(sock, "client"))
+                elif r in waiting:
+                    requests = r.receive()
+                    if requests is None:
+                        waiting.remove(r)
+                        r.close()
+                    elif requests:
+                        waiting.remove(r)
+                        queue.append((r, requests[0]))
+                elif streams.has_key(r) and streams[r][0].sentinel is not None:
+                    (w, name) = streams[r]
+                    data = os.read(r.fileno(), 1 << 16)
+                    if not data:
+                        #it quit, perhaps by the script's quit() or exit.
+                        status = w.process.wait()
+                        if status < 0:
+                            #killed by a signal, as a shell would report it.
+                            status = 128 - status
+                        w.finish(status)
+                        pool[pool.index(w)] = Interpreter(command)
+                    elif w.forward(name, data):
+                        w.finish(w.status)
+    except KeyboardInterrupt:
+        return 0
+    finally:
+        for w in pool:
+            w.stop()
+        server.close()
+        os.remove(path)
+
+def interpMain(argv):
+    """monk.py interp: run an R or MATLAB script on an interpreter kept by
+    `monk.py interp-server`, or by starting one if there's no server."""
+    parser = argparse.ArgumentParser(
+        prog="monk.py interp",
+        description="Run a script as `Rscript SCRIPT ARGS` or "
+        "`autodep/runmatlab SCRIPT ARGS` would, but on an interpreter "
+        "kept running by `monk.py interp-server`, passing on its output and "
+        "exit status. Without a server, runs Rscript or runmatlab.")
+    parser.add_argument('kind', choices=sorted(interpreters))
+    parser.add_argument('--socket',
+                        help="The server's socket. (default "
+                        "tags/.interp-KIND.sock)")
+    parser.add_argument('script')
+    parser.add_argument('args', nargs=argparse.REMAINDER)
+    args = parser.parse_args(argv)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(args.socket or interpSocket(args.kind))
+    except socket.error:
+        sock.close()
+        if args.kind == "r":
+            fallback = ["Rscript", args.script]
         else:
-            return ""
+            fallback = [os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                     "autodep", "runmatlab"), args.script]
+        try:
+            status = subprocess.call(fallback + args.args)
+        except OSError as e:
+            print("monk: no interpreter server, and can't run {0}: {1}".format(
+                fallback[0], e.strerror), file=sys.stderr)
+            return 127
+        return 128 - status if status < 0 else status
+    connection = Connection(sock, "server")
+    connection.send({"script": os.path.abspath(args.script), "args": args.args,
+                     "cwd": os.getcwd()})
+    outputs = {"out": getattr(sys.stdout, "buffer", sys.stdout),
+               "err": getattr(sys.stderr, "buffer", sys.stderr)}
+    while True:
+        message = connection.read()
+        if message is None:
+            print("monk: lost the interpreter server", file=sys.stderr)
+            return 1
+        for (stream, out) in outputs.items():
+            if message.has_key(stream):
+                out.write(message[stream].encode("utf-8"))
+                out.flush()
+        if message.has_key("status"):
+            return message["status"]
+
+##subcommands that generated rules call back into.
+helpers = {"exec": execMain, "worker": workerMain, "artifacts": artifactsMain,
+           "batch": batchMain, "scan-deps": scanDepsMain,
+           "interp": interpMain, "interp-server": interpServerMain}
+
+class Job(object):
+    """A rule as the executor sees it."""
+    def __init__(self, rule):
+        words = rule.words
+        phony = set([w.word for w in words if w.phony])
+        self.rule = rule
+        self.targets = distinct(rule.products())
+        #phony outputs name the rule rather than a file.
+        self.outputs = [p for p in self.targets if p not in phony]
+        self.dependencies = [d for d in distinct(rule.dependencies())
+                             if d not in phony]
+        self.command = rule.commandLine()
+        self.dirs = distinct([os.path.split(w.word)[0] for w in words
+                              if w.mkdir and os.path.split(w.word)[0] != ""])
+        self.listings = distinct([w.word for w in words if w.listing])
+        self.upstream = []
+        self.downstream = []
+        self.waiting = 0
+        self.priority = 0
+        self.ran = False
+        #(name, size) of the pool it runs in, if any.
+        self.pool = None
+
+    def name(self):
+        return " ".join(self.targets)
+
+class LocalRunner(object):
+    """Runs commands as child processes of this one."""
+    def __init__(self):
+        self.running = {}
 
-    def phonyRule(self):
-        phonyWords = [x for x in self.words if x.phony]
+    def start(self, job, command):
+        pid = os.spawnv(os.P_NOWAIT, "/bin/sh", ["sh", "-c", command])
+        self.running[pid] = job
 
-        if phonyWords:
-            phonyRule = "\n\n".join(["{0}: {1}".format(x.word, " ".join(self.products()))
-                                        for x in phonyWords if not (x.output or x.input)])
-            phonyDecl = "\n\n.PHONY: {0}\n\n".format(" ".join([x.word for x in phonyWords]))
-            return phonyRule + phonyDecl
+    def wait(self):
+        """Wait for a command to finish; returns the job and its exit status."""
+        while True:
+            try:
+                (pid, status) = os.wait()
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            if pid in self.running:
+                break
+        job = self.running.pop(pid)
+        if os.WIFEXITED(status):
+            return (job, os.WEXITSTATUS(status))
         else:
-            return ""
+            return (job, 128 + os.WTERMSIG(status))
+
+class RemoteRunner(object):
+    """Runs commands on workers (monk.py worker) over sockets, one at a
+    time on each. Commands wait their turn if every worker is busy. If a
+    worker is lost, the command it was running is sent to another, up to
+    `retries` times; a command that fails isn't retried.
+
+    The workers run in the same directory as the executor, so they need
+    to share its file system. Each connection starts by giving the token,
+    which workers started here get a fresh one of."""
+    def __init__(self, addresses=[], local=0, retries=2, token=None):
+        self.retries = retries
+        self.processes = []
+        self.workers = []
+        self.pending = []
+        self.done = []
+        self.tries = {}
+        tokens = [(a, token) for a in addresses]
+        localToken = hashlib.sha1(os.urandom(32)).hexdigest()
+        for n in range(local):
+            #workers on this machine, standing in for other nodes.
+            p = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                                  "worker"], stdout=subprocess.PIPE,
+                                 env=dict(os.environ, MONK_WORKER_TOKEN=localToken))
+            self.processes.append(p)
+            line = p.stdout.readline().decode("utf-8").split()
+            if not line:
+                raise Exception("a local worker didn't start")
+            tokens.append((line[-1], localToken))
+        for (a, t) in tokens:
+            try:
+                sock = socket.create_connection(splitAddress(a))
+            except socket.error as e:
+                raise Exception("can't reach worker {0}: {1}".format(a, e))
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            connection = Connection(sock, a)
+            connection.send({"token": t})
+            reply = connection.read()
+            if reply is None or not reply.get("ok"):
+                connection.close()
+                raise Exception("worker {0} refused the connection: {1}".format(
+                    a, (reply or {}).get("error", "it hung up")))
+            self.workers.append(connection)
 
-    def intermediateRule(self):
-        intermediateTargets = [x.word for x in self.words if x.intermediate]
+    def start(self, job, command):
+        self.pending.append((job, command))
+        self.dispatch()
 
-        if intermediateTargets:
-            return ".INTERMEDIATE: {0}\n\n".format(" ".join(intermediateTargets))
+    def dispatch(self):
+        for w in list(self.workers):
+            if w.job is not None or not self.pending:
+                continue
+            (job, command) = self.pending.pop(0)
+            w.job = (job, command)
+            try:
+                w.send({"command": command, "directory": os.getcwd(),
+                        "dirs": job.dirs, "outputs": job.outputs})
+            except socket.error:
+                self.lose(w)
+
+    def lose(self, worker):
+        print("monk: lost worker {0}".format(worker.name), file=sys.stderr)
+        self.workers.remove(worker)
+        worker.close()
+        if worker.job is None:
+            return
+        (job, command) = worker.job
+        tries = self.tries.get(id(job), 0) + 1
+        self.tries[id(job)] = tries
+        if tries > self.retries or not self.workers:
+            print("monk: *** [{0}] lost {1} worker(s) running it"
+                  .format(job.name(), tries), file=sys.stderr)
+            self.done.append((job, 255))
         else:
-            return ""
+            self.pending.insert(0, (job, command))
 
-    def commandLine(self):
-        return " ".join([i.word for   i  in self.words if not i.invisible])
+    def wait(self):
+        """Wait for a command to finish; returns the job and its exit status."""
+        while not self.done:
+            if not self.workers:
+                (job, command) = self.pending.pop(0)
+                print("monk: *** [{0}] no workers left".format(job.name()),
+                      file=sys.stderr)
+                return (job, 255)
+            busy = [w for w in self.workers if w.job is not None]
+            for w in select.select(busy, [], [])[0]:
+                replies = w.receive()
+                if replies is None:
+                    self.lose(w)
+                    continue
+                for reply in replies:
+                    (job, command) = w.job
+                    w.job = None
+                    self.finish(w, job, reply)
+            self.dispatch()
+        return self.done.pop(0)
 
-def unique(seq, idfun=id):
-    # order preserving prune of a list by object identity
-    seen = {}
-    result = []
-    for item in seq:
-        marker = idfun(item)
-        if marker in seen: continue
-        seen[marker] = 1
-        result.append(item)
-    return result
+    def finish(self, worker, job, reply):
+        sys.stdout.write(reply["output"])
+        sys.stdout.flush()
+        if reply["status"] == 0:
+            for o in job.outputs:
+                if reply["outputs"].get(o) is None:
+                    print("monk: warning: [{0}] worker {1} didn't make {2}"
+                          .format(job.name(), worker.name, o), file=sys.stderr)
+        self.done.append((job, reply["status"]))
+
+    def close(self):
+        for w in self.workers:
+            w.close()
+        for p in self.processes:
+            p.terminate()
+            p.wait()
+
+def makeRunner(worker=None, local_workers=0, retries=2, worker_token_file=None,
+               **kwargs):
+    """The RemoteRunner called for by the command line options, or None
+    to run commands here."""
+    if worker or local_workers:
+        return RemoteRunner(worker or [], local_workers, retries,
+                            workerToken(worker_token_file))
+    return None
+
+def mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+class Executor(object):
+    """Runs the rules from generateRules directly, in dependency order and
+    up to `slots` commands at a time.
+
+    A rule runs if any of its outputs is missing or older than any of its
+    dependencies, or if a rule it depends on has run. Multiple outputs
+    need no tag files, since each rule runs at most once. Among the rules
+    that are ready, those heading the longest remaining chains go first.
+    No more of the rules in a pool run at once than its size allows."""
+    def __init__(self, rules, slots=1, runner=None, wrapper=None, pools=None):
+        self.jobs = [Job(r) for r in rules]
+        for j in self.jobs:
+            j.pool = rulePool(j.rule, pools)
+        self.slots = slots
+        self.runner = runner if runner is not None else LocalRunner()
+        self.wrapper = wrapper
+        self.producers = {}
+        for j in self.jobs:
+            for t in j.targets:
+                self.producers[t] = j
+        for j in self.jobs:
+            j.upstream = unique([self.producers[d] for d in j.dependencies
+                                 if self.producers.has_key(d)
+                                 and self.producers[d] is not j])
+            for u in j.upstream:
+                u.downstream.append(j)
+        self.prioritize()
+
+    def order(self):
+        """The jobs in dependency order."""
+        waiting = dict([(id(j), len(j.upstream)) for j in self.jobs])
+        ready = [j for j in self.jobs if waiting[id(j)] == 0]
+        order = []
+        while ready:
+            j = ready.pop()
+            order.append(j)
+            for d in j.downstream:
+                waiting[id(d)] = waiting[id(d)] - 1
+                if waiting[id(d)] == 0:
+                    ready.append(d)
+        if len(order) < len(self.jobs):
+            stuck = [j for j in self.jobs if waiting[id(j)] > 0]
+            raise Exception("circular dependency involving {0}"
+                            .format(stuck[0].name()))
+        return order
+
+    def weight(self, job):
+        return 1 if job.command else 0
+
+    def prioritize(self):
+        #the length of the longest chain of commands from each job onwards.
+        for j in reversed(self.order()):
+            downstream = [d.priority for d in j.downstream] or [0]
+            j.priority = self.weight(j) + max(downstream)
 
-def generateRules(files, commands, maxdepth, maxfiles, verbose=False, **kwargs):
-    files = list(files)
-
-    ##track the commands used to generate each target.
-    commandsDict = dict([(x, None) for x in files])
-
-    ##track the depth of generation for both targets and dependencies of rules.
-    depthDict = dict([(x, 0) for x in files])
-
-    ##For each target in order try matching a command pattern against
-    ##it. When a new target is generated, extend the file list (that
-    ##you are iterating over.)
-
-    for consideredTarget in files:
-        for commandPattern in commands:
-            matchedCommand = commandPattern.tryMatch(consideredTarget)
-            if matchedCommand is not None:
-                if verbose:
-                    print('-'*3, file=sys.stderr)
-                    print("matched: {0}".format(consideredTarget), file=sys.stderr)
-                    print("with command: {0}".format(matchedCommand.description()), file=sys.stderr)
-                #See what files are produced by this command.
-                #Add them to the products list for perusal.
-                products = matchedCommand.products()
-                #Are some of these products already being produced?
-                #If so the commands will have to be merged.
-                previousCommands = unique([commandsDict[o] for o in products
-                                     if commandsDict.has_key(o)
-                                     and commandsDict[o] is not None])
-                targetsWereCovered = unique([i
-                                             for c in previousCommands
-                                             for i in c.products()])
-                [commandsDict.pop(i)
-                 for i in unique(targetsWereCovered, lambda a:a)]
-
-                if len(previousCommands) > 0:
-                    mergedCommand = previousCommands[0]
-                    mergedCommand.merge(*(previousCommands[1:] + [matchedCommand]))
-                    if verbose:
-                        print("merged into command: {0}".format(mergedCommand.commandLine()), file=sys.stderr)
+    def needsRun(self, job):
+        """Return True if the job must run, False if it is up to date, or
+        a message if it can't be run."""
+        if [u for u in job.upstream if u.ran]:
+            return True
+        newest = None
+        for d in job.dependencies:
+            t = mtime(d)
+            if t is None:
+                if self.producers.has_key(d):
+                    return True
+                return "No rule to make target '{0}', needed by '{1}'".format(
+                    d, job.name())
+            newest = t if newest is None else max(newest, t)
+        if job.command and not job.outputs:
+            #only phony outputs, which are made every time.
+            return True
+        times = [mtime(o) for o in job.outputs]
+        if None in times:
+            return True
+        return bool(times) and newest is not None and newest > min(times)
+
+    def run(self):
+        """Run the jobs. Returns 0 on success, 1 if a command failed, or
+        "restart" if a listing file changed, which means the rules must be
+        generated again."""
+        for j in self.jobs:
+            j.waiting = len(j.upstream)
+        ready = []
+        for (n, j) in enumerate(self.jobs):
+            if j.waiting == 0:
+                heapq.heappush(ready, (-j.priority, n, j))
+        index = dict([(id(j), n) for (n, j) in enumerate(self.jobs)])
+        running = {}
+        #how many of each pool's rules are running, and those waiting.
+        busy = {}
+        held = []
+        failed = False
+        restart = False
+        while ready or running:
+            while ready and len(running) < self.slots and not (failed or restart):
+                job = heapq.heappop(ready)[2]
+                need = self.needsRun(job)
+                if need is True and job.command:
+                    if job.pool is not None:
+                        (name, size) = job.pool
+                        if busy.get(name, 0) >= size:
+                            held.append(job)
+                            continue
+                        busy[name] = busy.get(name, 0) + 1
+                    running[id(job)] = self.start(job)
+                    continue
+                if need is True or need is False:
+                    job.ran = need is True
+                    released = self.finish(job)
                 else:
-                    mergedCommand = matchedCommand
-
-                newProducts = mergedCommand.products()
-                newDependencies = mergedCommand.dependencies()
-                prevDepth = depthDict[consideredTarget]
-
-                if prevDepth >= maxdepth:
-                    raise Exception("target generation went too deep at {0}"
-                                    .format(consideredTarget))
-
-                for i in newProducts:
-                    commandsDict[i] = mergedCommand
-
-                newFiles = [p for p in newProducts + newDependencies
-                            if not depthDict.has_key(p)]
-                if verbose:
-                    print("new files (depth {0}): {1}".format(prevDepth+1, " ".join(newFiles)), file=sys.stderr)
-                files.extend(newFiles)
-
-                if len(files) >= maxfiles:
-                    raise Exception("too many files generated at {0}"
-                                    .format(consideredTarget))
-
-                for i in newProducts + newDependencies:
-                    depthDict[i] = prevDepth+1
-
-                # [print(i.makeRule(), file=sys.stderr) for i in
-                #  unique([commandsDict[i] for i in files
-                #          if commandsDict.has_key(i)
-                #          and commandsDict[i] is not None])]
-                # print('-'*80, file=sys.stderr)
-
-    unmatchedCommands = [c for c in commands if c.matchCount == 0]
-    for c in unmatchedCommands:
-        print("warning: unmatched command: {0}\n"
-              .format(c.description()),
-              file=sys.stderr)
+                    print("monk: *** {0}.".format(need), file=sys.stderr)
+                    failed = True
+                    released = []
+                for d in released:
+                    heapq.heappush(ready, (-d.priority, index[id(d)], d))
+            if not running:
+                break
+            (job, status) = self.runner.wait()
+            (started, listed) = running.pop(id(job))
+            if job.pool is not None:
+                busy[job.pool[0]] = busy[job.pool[0]] - 1
+                for h in [h for h in held if h.pool[0] == job.pool[0]]:
+                    held.remove(h)
+                    heapq.heappush(ready, (-h.priority, index[id(h)], h))
+            if status != 0:
+                print("monk: *** [{0}] Error {1}".format(job.name(), status),
+                      file=sys.stderr)
+                self.removeOutputs(job, started)
+                failed = True
+                continue
+            job.ran = True
+            if [l for l in job.listings if getList(l) != listed[l]]:
+                restart = True
+            for d in self.finish(job):
+                heapq.heappush(ready, (-d.priority, index[id(d)], d))
+        if failed:
+            return 1
+        if restart:
+            return "restart"
+        return 0
+
+    def start(self, job):
+        for d in job.dirs:
+            if not os.path.isdir(d):
+                os.makedirs(d)
+        listed = dict([(l, getList(l)) for l in job.listings])
+        print(job.command)
+        sys.stdout.flush()
+        started = time.time()
+        command = job.command
+        if self.wrapper is not None:
+            command = self.wrapper.wrap(command, job.dependencies, job.outputs,
+                                        monkCommand())
+        self.runner.start(job, command)
+        return (started, listed)
+
+    def finish(self, job):
+        """Mark a job done; return the jobs that are now ready."""
+        released = []
+        for d in job.downstream:
+            d.waiting = d.waiting - 1
+            if d.waiting == 0:
+                released.append(d)
+        return released
+
+    def removeOutputs(self, job, started):
+        #outputs written by a failed command can't be trusted.
+        for o in job.outputs:
+            t = mtime(o)
+            if t is not None and t >= started and os.path.isfile(o):
+                print("monk: deleting '{0}'".format(o), file=sys.stderr)
+                os.remove(o)
+
+def runRules(jobs=1, profile=None, **kwargs):
+    """Generate the rules and run them, generating them again whenever a
+    listing file changes."""
+    runner = makeRunner(**kwargs)
+    slots = jobs if runner is None else len(runner.workers)
+    try:
+        while True:
+            started = time.time()
+            rules = generateRules(jobs=jobs, profile=profile, **kwargs)
+            if kwargs.get("goal"):
+                rules = goalRules(rules, kwargs["goal"])[0]
+            rules = batchRules(rules, kwargs["commands"], kwargs.get("tagdir", "tags"))
+            generated = time.time()
+            generatedPeak = maxrssKB()
+            writeManifests(rules)
+            status = Executor(rules, slots, runner,
+                              wrapper=makeWrapper(pooled=False, **kwargs),
+                              pools=rulePools(kwargs["commands"],
+                                              kwargs.get("pools"))).run()
+            if profile is not None:
+                profile.phase("generate", generated - started, generatedPeak)
+                profile.phase("run", time.time() - generated, maxrssKB())
+            if status != "restart":
+                return status
+    finally:
+        if runner is not None:
+            runner.close()
+
+##inotify events that may mean files have come or gone, or a listing
+##or @-file has changed: IN_CLOSE_WRITE, IN_MOVED_FROM, IN_MOVED_TO,
+##IN_CREATE, IN_DELETE and IN_DELETE_SELF.
+watchMask = 0x08 | 0x40 | 0x80 | 0x100 | 0x200 | 0x400
 
-    # commands uniquely in order of creation.
-    return unique([commandsDict[i] for i in files
-                   if commandsDict.has_key(i)
-                   and commandsDict[i] is not None])
+class Watcher(object):
+    """Waits until something may have changed in a set of directories,
+    using inotify where there is one and otherwise polling."""
+    def __init__(self, interval):
+        self.interval = interval
+        self.libc = None
+        self.fd = None
+        try:
+            import ctypes, ctypes.util
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            fd = libc.inotify_init()
+        except (ImportError, OSError, AttributeError, TypeError):
+            return
+        if fd >= 0:
+            self.libc = libc
+            self.fd = fd
+
+    def watch(self, directories):
+        #adding a watch that exists already is harmless, and the kernel
+        #drops the watches of directories that go away.
+        if self.fd is not None:
+            for d in distinct(directories):
+                self.libc.inotify_add_watch(self.fd, toBytes(d), watchMask)
+
+    def wait(self):
+        if self.fd is None:
+            time.sleep(self.interval)
+            return
+        select.select([self.fd], [], [])
+        #let a burst of changes settle, and take them all at once.
+        while select.select([self.fd], [], [], 0.1)[0]:
+            os.read(self.fd, 1 << 16)
+
+def emitOutput(emitter, changedOnly=False, finder=None, **kwargs):
+    """Write the output called for by the command line options. Returns
+    whether anything was written."""
+    path = kwargs.get("makefile")
+    if kwargs.get("shard"):
+        if kwargs.get("backend") == "ninja":
+            raise Exception("--shard only works with --backend make")
+        if path is None or path == "-":
+            raise Exception("--shard needs a Makefile to write (-o)")
+        return emitter.writeShards(path, kwargs["shard"],
+                                   regeneration(path, sys.argv[1:], finder))
+    return writeOutput(path, emitter.write, changedOnly)
+
+def makeEmitter(rules, goals=None, finder=None, **kwargs):
+    """The emitter for the backend in the command line options. The
+    finder is the one that looked for the base files, if any."""
+    pools = rulePools(kwargs["commands"], kwargs.get("pools"))
+    if kwargs.get("backend") == "ninja":
+        path = kwargs.get("makefile")
+        regenerate = None
+        if path is not None and path != "-":
+            regenerate = regeneration(path, sys.argv[1:], finder)
+        #ninja has pools of its own.
+        return NinjaEmitter(rules, makeWrapper(touch=False, pooled=False, **kwargs),
+                            regenerate, goals, pools)
+    return MakefileEmitter(rules, kwargs.get("tagdir", "tags"),
+                           makeWrapper(**kwargs),
+                           kwargs.get("pattern_rules", False), goals, pools)
+
+def watchRules(commands, watch_interval=1.0, **kwargs):
+    """Generate the rules and write them out, then keep the rule graph in
+    memory, bringing it and the output up to date whenever base files
+    come or go or a listing changes. Only the groups of rules those
+    changes touch are generated again (see RuleGraph.update), but the
+    directories are scanned and the output put together again in full.
+    If an @-file changes, start over."""
+    path = kwargs.get("makefile")
+    if path is None or path == "-":
+        raise Exception("--watch needs an output file (-o)")
+    argfiles = [a[1:] for a in sys.argv[1:] if a.startswith("@")]
+    stamps = [mtime(a) for a in argfiles]
+    watcher = Watcher(watch_interval)
+    graph = None
+    base = None
+    listings = {}
+    while True:
+        finder = FileFinder(commands, kwargs.get("ignore") or [],
+                            kwargs.get("tagdir", "tags"))
+        try:
+            files = findFiles(kwargs.get("files"), commands, kwargs.get("scan"),
+                              kwargs.get("git_index"), kwargs.get("ignore"),
+                              finder)
+            found = []
+            if kwargs.get("scan"):
+                given = set(kwargs.get("files") or [])
+                found = [f for f in files if f not in given]
+            if graph is None:
+                options = dict(kwargs, files=files, scan=None, git_index=False,
+                               found=found)
+                graph = buildGraph(commands=commands, **options)
+                changed = True
+            else:
+                changed = (files != base or
+                           [l for l in listings if getList(l) != listings[l]])
+                if changed:
+                    graph.update(files)
+                    graph.withoutProducts(found)
+                    if kwargs.get("cache") and graph.changed:
+                        saveGraph(cachePath(kwargs.get("tagdir", "tags")), graph)
+            base = files
+            listings = graph.listed
+            if changed:
+                rules = graph.rules()
+                goals = None
+                if kwargs.get("goal"):
+                    (rules, goals) = goalRules(rules, kwargs["goal"])
+                rules = batchRules(rules, commands, kwargs.get("tagdir", "tags"))
+                emitter = makeEmitter(rules, goals, finder, commands=commands,
+                                      **kwargs)
+                wrote = emitOutput(emitter, changedOnly=True, finder=finder,
+                                   **kwargs)
+                writeManifests(rules)
+                if wrote:
+                    print("monk: wrote {0} ({1} rules)".format(path, len(rules)),
+                          file=sys.stderr)
+        except Exception as e:
+            #start from scratch once something changes.
+            print("monk: {0}".format(e), file=sys.stderr)
+            graph = None
+        watcher.watch(finder.walked + argfiles +
+                      [os.path.dirname(l) or os.curdir for l in listings] +
+                      [os.path.dirname(a) or os.curdir for a in argfiles] +
+                      ([".git"] if kwargs.get("git_index") else []))
+        watcher.wait()
+        if [a for (a, t) in zip(argfiles, stamps) if mtime(a) != t]:
+            print("monk: {0} changed, restarting".format(" ".join(argfiles)),
+                  file=sys.stderr)
+            os.execv(sys.executable, [sys.executable] + sys.argv)
 
 class ShlexArgParser(argparse.ArgumentParser):
     def convert_arg_line_to_args(self, arg_line):
         return shlex.split(arg_line, comments=True)
 
+def argFiles(args, seen=None):
+    """The @-files named in args, and those named in them in turn, in the
+    order the parser reads them."""
+    if seen is None:
+        seen = []
+    for a in args:
+        if a.startswith("@") and a[1:] not in seen:
+            seen.append(a[1:])
+            with open(a[1:]) as f:
+                words = [w for line in f.read().splitlines()
+                         for w in shlex.split(line, comments=True)]
+            argFiles(words, seen)
+    return seen
+
+def compiledPath(argv, tagdir=None):
+    """Where to keep the parsed arguments: in the tag directory, named for
+    the first @-file, or None if there isn't one (and so nothing much to
+    save). Before parsing, the tag directory is only known if it's given
+    on the command line itself."""
+    if tagdir is None:
+        tagdir = "tags"
+        for (a, b) in zip(argv, argv[1:] + [None]):
+            if a == "--tagdir" and b is not None:
+                tagdir = b
+            elif a.startswith("--tagdir="):
+                tagdir = a[len("--tagdir="):]
+    for a in argv:
+        if a.startswith("@"):
+            name = hashlib.sha1(toBytes(os.path.abspath(a[1:]))).hexdigest()
+            return os.path.join(tagdir, ".monkargs", name)
+    return None
+
+def argsKey(argv, paths):
+    """What the parsed arguments depend on: this monk, the working
+    directory, the arguments and the contents of the @-files."""
+    state = os.stat(os.path.abspath(__file__))
+    digests = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            digests.append(hashlib.sha1(f.read()).hexdigest())
+    return (cacheVersion, state.st_mtime, state.st_size, os.getcwd(),
+            list(argv), list(paths), digests)
+
+def loadCompiled(path, argv):
+    """The namespace saved by saveCompiled, or None if it's missing or
+    any of what it was parsed from has changed."""
+    try:
+        with open(path, 'rb') as f:
+            (key, namespace) = pickle.load(f)
+        if key != argsKey(argv, key[5]):
+            return None
+    except Exception:
+        return None
+    return namespace
+
+def saveCompiled(path, argv, namespace):
+    try:
+        key = argsKey(argv, argFiles(argv))
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        temp = path + ".tmp"
+        with open(temp, 'wb') as f:
+            pickle.dump((key, namespace), f, pickle.HIGHEST_PROTOCOL)
+        os.rename(temp, path)
+    except (IOError, OSError):
+        #somewhere we can't write; just parse again next time.
+        pass
+
+def parseArgs(argv):
+    """Parse the command line. With --cache, the commands parsed from the
+    @-files are saved, and later runs load them instead of parsing again
+    until the arguments or any @-file (or anything it includes) change."""
+    path = compiledPath(argv)
+    namespace = None
+    if path is not None:
+        namespace = loadCompiled(path, argv)
+    if namespace is None:
+        namespace = makeparser().parse_args(
+            argv, namespace=argparse.Namespace(commands=[], files=[]))
+        #not if --tagdir was in an @-file, as it couldn't be found again.
+        if (namespace.cache and path is not None and
+            path == compiledPath(argv, namespace.tagdir)):
+            saveCompiled(path, argv, namespace)
+    elif namespace.verbose:
+        print("cache: loaded the commands from {0}".format(path), file=sys.stderr)
+    return namespace
+
 def makeparser():
     """The command line argument parser."""
     theWord = [UnmatchedWord()]
@@ -504,6 +3876,43 @@ def makeparser():
                 setattr(theWord[0], flagname, True)
             super(SetFlag, self).__call__(parser, namespace, values, option_string)
 
+    class SetBatch(AddWords):
+        def __call__(self, parser, namespace, values, option_string):
+            if not getattr(namespace, "commands", None):
+                raise argparse.ArgumentError(self, "must follow --command")
+            try:
+                namespace.commands[-1].batch = int(values[0])
+            except ValueError:
+                raise argparse.ArgumentError(self, "expected a number, not "
+                                             "{0}".format(values[0]))
+            super(SetBatch, self).__call__(parser, namespace, values[1:],
+                                           option_string)
+
+    class SetPool(AddWords):
+        def __call__(self, parser, namespace, values, option_string):
+            if ":" in values[0]:
+                #a declaration.
+                (name, size) = values[0].rsplit(":", 1)
+                if not re.match(r"[A-Za-z_][A-Za-z0-9_]*\Z", name):
+                    raise argparse.ArgumentError(self, "bad pool name {0}"
+                                                 .format(name))
+                try:
+                    size = int(size)
+                except ValueError:
+                    raise argparse.ArgumentError(self, "expected a number, "
+                                                 "not {0}".format(size))
+                if getattr(namespace, "pools", None) is None:
+                    namespace.pools = {}
+                namespace.pools[name] = size
+            elif not getattr(namespace, "commands", None):
+                raise argparse.ArgumentError(self, "must follow --command, "
+                                             "or be NAME:SIZE")
+            else:
+                namespace.commands[-1].pool = values[0]
+            if values[1:]:
+                super(SetPool, self).__call__(parser, namespace, values[1:],
+                                              option_string)
+
     class PushDir(argparse.Action):
         def __call__(self, parser, namespace, values, option_string):
             directoryPrefix.extend(values)
@@ -530,6 +3939,26 @@ def makeparser():
                         help="The next word specifies an input file.")
     parser.add_argument('--output', action=SetFlag, nargs='*', dest="",
                         help="The next word specifies an output file.")
+    parser.add_argument('--batch', action=SetBatch, nargs='+', dest="",
+                        metavar="N",
+                        help="Run up to N of this command's rules in one "
+                        "invocation, for programs that are slow to start. "
+                        "The invocation gets the words that don't depend on "
+                        "the match, then a file with a line of "
+                        "tab-separated words that do for each rule out of "
+                        "date. Only rules from a single match, with no "
+                        "--once, --listing or phony input or output words, "
+                        "are batched.")
+    parser.add_argument('--pool', action=SetPool, nargs='+', dest="",
+                        metavar="NAME[:SIZE]",
+                        help="With NAME:SIZE, declare a pool that lets at "
+                        "most SIZE rules run at once. With NAME, put this "
+                        "command's rules in that pool. Generated Makefiles "
+                        "hold a slot (a lock file in the tag directory) "
+                        "while running a pooled rule, so the rest of the "
+                        "build can use a high -j; ninja and --run limit the "
+                        "pool themselves.")
+    parser.set_defaults(pools=None)
     parser.add_argument('--once', action=SetFlag, nargs='*', dest="",
                         help="The word will only be included once. (the "
                         "first such word must be marked 'once' for it to "
@@ -557,16 +3986,154 @@ def makeparser():
                         "intermediate. This is done by default for any rules "
                         "with multiple outputs (including listing files.)")
 
-    parser.add_argument('--maxdepth', nargs=1, default=100, type=int,
+    parser.add_argument('--maxdepth', default=100, type=int,
                         help="The maximum depth of file "
                         "generation to tolerate. (default: 100)")
-    parser.add_argument('--maxfiles', nargs=1, default=10000, type=int,
+    parser.add_argument('--maxfiles', default=10000, type=int,
                         help="The maximum number of targets "
                         "to consider. (default 10000)")
-    parser.add_argument('--tagdir', nargs=1, default="tags",
+    parser.add_argument('-o', '--makefile', default=None,
+                        help="Write the Makefile to this file instead of "
+                        "standard output. (The file is replaced only once "
+                        "it has been completely written.)")
+    parser.add_argument('--backend', choices=["make", "ninja"], default="make",
+                        help="Write a Makefile for GNU make (the default) or "
+                        "a build.ninja for ninja. Ninja needs no tag files "
+                        "for rules with several outputs, and when writing "
+                        "to a file the build.ninja regenerates itself when "
+                        "the @-files or listings it was made from change, "
+                        "or files come or go in the directories given to "
+                        "--scan (other than the one the build.ninja is in) "
+                        "or in the git index, with --git-index. "
+                        "--intermediate and --pattern-rules only apply to "
+                        "make.")
+    parser.add_argument('--tagdir', default="tags",
                         help="the directory tag files are stored in.")
+    parser.add_argument('-j', '--jobs', default=1, type=int,
+                        help="Match files against commands using this many "
+                        "processes. The result is the same as with one.")
+    parser.add_argument('--goal', nargs='+', metavar="TARGET",
+                        help="Only write (or run) the rules needed to make "
+                        "the targets matching these regexps, which must "
+                        "match the whole name. The Makefile's default "
+                        "target makes them.")
+    parser.add_argument('--run', action='store_true',
+                        help="Instead of writing a Makefile, run the commands "
+                        "that are out of date, --jobs at a time.")
+    parser.add_argument('--worker', action='append', metavar="HOST:PORT",
+                        help="With --run, send the commands to a worker "
+                        "started with `monk.py worker --listen HOST:PORT` "
+                        "instead of running them here, one per worker at a "
+                        "time. The workers must see this directory at the "
+                        "same path. (May be given more than once.)")
+    parser.add_argument('--worker-token-file', metavar="FILE",
+                        help="A file holding the token the --worker workers "
+                        "were started with. (default $MONK_WORKER_TOKEN)")
+    parser.add_argument('--local-workers', type=int, default=0, metavar="N",
+                        help="With --run, start N workers on this machine "
+                        "and run the commands on them, as --worker would.")
+    parser.add_argument('--retries', type=int, default=2,
+                        help="How many times to send a command to another "
+                        "worker after losing the one running it. (default 2)")
+    parser.add_argument('--pattern-rules', action='store_true',
+                        help="Write rules that differ only in the part of "
+                        "the file name matched by a single group as one "
+                        "static pattern rule, which makes for a much smaller "
+                        "Makefile. Rules from merged matches, and those "
+                        "with phony, listing or multiple outputs, are "
+                        "still written out one by one.")
+    parser.add_argument('--shard', metavar="DIR",
+                        help="Write the rules begun by each command to a "
+                        "fragment in this directory, and make the output "
+                        "file (-o) an index that includes them. When a "
+                        "listing changes, make runs monk again, which "
+                        "rewrites only the fragments that changed or that "
+                        "use the listing. (Works best with --cache, and "
+                        "--scan or --git-index to keep the command short.)")
+    parser.add_argument('--watch', action='store_true',
+                        help="Write the output file (-o), then keep running: "
+                        "when base files found by --scan or --git-index "
+                        "come or go, or a listing changes, update the rules "
+                        "in memory and rewrite the file if it changed. "
+                        "Only the rules the changed files lead to (and the "
+                        "rules sharing files with those) are generated "
+                        "again, but each change rescans the directories and "
+                        "puts the whole output together again; with --shard "
+                        "only the fragments that changed are written. "
+                        "Uses inotify where available, otherwise polls.")
+    parser.add_argument('--watch-interval', type=float, default=1.0,
+                        metavar="SECONDS",
+                        help="How often --watch polls when it can't use "
+                        "inotify. (default 1)")
+    parser.add_argument('--hashed', action='store_true',
+                        help="Run commands through a wrapper that skips them "
+                        "when their command line and the contents of their "
+                        "inputs are unchanged since they last succeeded, "
+                        "so that touched or identically rebuilt files don't "
+                        "cause work downstream. Digests are kept under the "
+                        "tag directory.")
+    parser.add_argument('--artifacts', metavar="DIR",
+                        help="Run commands through a wrapper that keeps their "
+                        "outputs in this directory (which may be shared by "
+                        "several checkouts), under a digest of the command "
+                        "line and the contents of the inputs, and restores "
+                        "copies of them from there instead of running the "
+                        "same command on the same inputs again. `monk.py "
+                        "artifacts DIR` shows how often it has helped.")
+    parser.add_argument('--artifacts-limit', type=parseSize, metavar="SIZE",
+                        help="Keep the artifact cache under this size (like "
+                        "500M or 20G) by evicting the least recently used "
+                        "entries.")
+    parser.add_argument('--timelog', metavar="FILE",
+                        help="Run commands through a wrapper that appends "
+                        "when each started and ended, its exit status, CPU "
+                        "time and peak memory to this file.")
+    parser.add_argument('--report', metavar="LOG",
+                        help="Instead of writing a Makefile, combine the "
+                        "rules with the timings in a --timelog file and "
+                        "report the critical path, CPU and wall time, how "
+                        "many commands ran at once, and the slowest rules "
+                        "of each command.")
+    parser.add_argument('--cache', action='store_true',
+                        help="Save the rule graph in the tag directory, and on "
+                        "later runs generate only the rules that base files "
+                        "which came or went (or a changed listing) lead to, "
+                        "and the rules sharing files with those, matching "
+                        "only files not seen before. The rules come out as "
+                        "they would without the cache. (Changing the "
+                        "commands starts over.) "
+                        "Also save the parsed arguments in the tag "
+                        "directory, so later runs with the same arguments and "
+                        "unchanged @-files skip parsing them.")
+    parser.add_argument('--profile', nargs='?', const="-", default=None,
+                        metavar="FILE",
+                        help="Report, for each command, how many files it "
+                        "was tried against and matched, how often its "
+                        "matches were merged, the new files it produced and "
+                        "the time spent matching and substituting; also the "
+                        "new files at each depth, the time taken by each "
+                        "phase and the peak memory as it ended (not counting "
+                        "the processes started by -j). A table is printed "
+                        "to stderr, or JSON is written to FILE.")
     parser.add_argument('--files', nargs='*',
                         help="The base set of files that are to be processed.")
+    parser.add_argument('--scan', action='append', metavar="DIR",
+                        help="Add the files found under this directory to "
+                        "the base set. Directories that no --match pattern "
+                        "could match anything in are skipped, as is the tag "
+                        "directory, and so are files a rule makes. Outputs "
+                        "no rule makes any more, such as those of a removed "
+                        "input, are still found. (May be given more than "
+                        "once.)")
+    parser.add_argument('--git-index', action='store_true',
+                        help="Add the files in the git index (as listed by "
+                        "`git ls-files`) to the base set, skipping those "
+                        "in directories no --match pattern could match "
+                        "anything in.")
+    parser.add_argument('--ignore', action='append', metavar="GLOB",
+                        help="Leave out files and directories found by "
+                        "--scan or --git-index whose path or name matches "
+                        "this glob. (May be given more than once.)")
     parser.add_argument('--pushdir', nargs=1,
                         help="Add a directory prefix for inputs and outputs."
                         "Useful when including a Monkfile from a subproject.",
@@ -657,6 +4224,445 @@ def testBreadth():
                 '--files test.a')
     goFromString(testargs)
 
+def testMergeDepth():
+    """A merge puts every file of the merged command not yet considered
+    at the depth of the file that matched, as the original monk did, and
+    not only the files the merge adds."""
+    ns = makeparser().parse_args(
+        shlex.split("--command cp --match --input '(b)\\.txt$' "
+                    "--output '{0}.copy' "
+                    "--command sum --once --output sum.txt "
+                    "--match --input '(.*)\\.txt$'"),
+        namespace=argparse.Namespace(commands=[]))
+    #b.txt is at depth 1 once it is a dependency of the first rule, so
+    #merging it into the second puts sum.txt at depth 2 before sum.txt
+    #is considered.
+    for (maxdepth, deep) in [(2, True), (3, False)]:
+        graph = RuleGraph(ns.commands, maxdepth, 1000)
+        graph.addFiles(["a.txt", "b.txt"])
+        try:
+            graph.expand()
+            raised = False
+        except Exception as e:
+            assert "too deep at sum.txt" in str(e), e
+            raised = True
+        assert raised == deep, maxdepth
+    print("merge depth ok")
+
+def testOutput():
+    """The makefile for a Monkfile using most of the word flags has the
+    rules the original monk wrote, with each list in order of first
+    appearance rather than in set order."""
+    def test():
+        writeFiles({"a.list": "data/x_2.txt\n",
+                    "Monkfile": "--command --once ./merge "
+                    "--once --output --mkdir 'pools/{0}.pool' "
+                    "--match --input 'data/([^_]*)_.*\\.txt$'\n"
+                    "--command ./tosql --match --input 'data/(.*)\\.txt$' "
+                    "--output --intermediate 'sql/{0}.sql'\n"
+                    "--command ./shove --match --input 'sql/(.*)\\.sql$' "
+                    "&& touch --output 'tickets/{0}.out' "
+                    "--phony --invisible dbupdated\n"
+                    "--command --output --invisible --tagged db "
+                    "--input --invisible --match 'tickets/.*\\.out$'\n"
+                    "--command plot --input --match 'pools/(.*)\\.pool$' "
+                    "--output 'graphs/{0}.a' --output 'graphs/{0}.b'\n"
+                    "--command check --output '{0}.check' "
+                    "--input --match --listing '(.*)\\.list$'\n"
+                    "--command --phony --output --invisible --once all "
+                    "--input --invisible --match '.*\\.check$'\n"})
+        out = monkOutput(["@Monkfile", "--files",
+                          "data/x_1.txt", "data/y_1.txt", "a.list"])
+        assert out == textwrap.dedent(expected), out
+    expected = """\
+    pools/x.pool: data/x_1.txt data/x_2.txt
+    	mkdir -p pools
+    	./merge pools/x.pool data/x_1.txt data/x_2.txt
+
+
+    sql/x_1.sql: data/x_1.txt
+    	./tosql data/x_1.txt sql/x_1.sql
+
+    .INTERMEDIATE: sql/x_1.sql
+
+
+    pools/y.pool: data/y_1.txt
+    	mkdir -p pools
+    	./merge pools/y.pool data/y_1.txt
+
+
+    sql/y_1.sql: data/y_1.txt
+    	./tosql data/y_1.txt sql/y_1.sql
+
+    .INTERMEDIATE: sql/y_1.sql
+
+
+    a.check: data/x_2.txt a.list
+    	check a.check a.list
+
+    $(lastword $(MAKEFILE_LIST)): a.list
+
+
+    tags/graphs/x.a: pools/x.pool
+    	mkdir -p tags/graphs
+    	touch tags/graphs/x.a
+    	plot pools/x.pool graphs/x.a graphs/x.b || ( rm tags/graphs/x.a && false )
+
+    graphs/x.a graphs/x.b: tags/graphs/x.a
+
+
+    tickets/x_1.out: sql/x_1.sql
+    	./shove sql/x_1.sql && touch tickets/x_1.out
+
+    dbupdated: tickets/x_1.out
+
+    .PHONY: dbupdated
+
+
+    tags/graphs/y.a: pools/y.pool
+    	mkdir -p tags/graphs
+    	touch tags/graphs/y.a
+    	plot pools/y.pool graphs/y.a graphs/y.b || ( rm tags/graphs/y.a && false )
+
+    graphs/y.a graphs/y.b: tags/graphs/y.a
+
+
+    tickets/y_1.out: sql/y_1.sql
+    	./shove sql/y_1.sql && touch tickets/y_1.out
+
+    dbupdated: tickets/y_1.out
+
+    .PHONY: dbupdated
+
+
+    all: a.check
+
+
+
+
+    .PHONY: all
+
+
+    sql/x_2.sql: data/x_2.txt
+    	./tosql data/x_2.txt sql/x_2.sql
+
+    .INTERMEDIATE: sql/x_2.sql
+
+
+    tags/db: tickets/x_1.out tickets/y_1.out tickets/x_2.out
+    	mkdir -p tags
+    	touch tags/db
+
+    db: tags/db
+
+
+    tickets/x_2.out: sql/x_2.sql
+    	./shove sql/x_2.sql && touch tickets/x_2.out
+
+    dbupdated: tickets/x_2.out
+
+    .PHONY: dbupdated
+
+
+    """
+    scratch(test)
+    print("output ok")
+
+def testPatternRules():
+    """With --pattern-rules, make runs the same commands as it does with
+    a rule written for each file."""
+    def test():
+        writeFiles({"Monkfile": "--command cp --match --input "
+                    "'data/(.*)\\.txt$' --output --mkdir 'out/{0}.txt'\n"
+                    "--command sort --match --input 'out/(.*)\\.txt$' "
+                    "> --output 'out/{0}.sorted'\n"
+                    "--command --once ./sum --once --output 'sum/{0}.txt' "
+                    "--match --input 'out/(?:sub/)?(s[0-9]+)_.*\\.sorted$'\n"
+                    "--command --phony --output --invisible --once all "
+                    "--input --invisible --match 'sum/.*'\n"})
+        files = ["data/s1_a.txt", "data/s1_b.txt", "data/s2_a.b.txt",
+                 "data/sub/s2_c.txt"]
+        writeFiles(dict([(f, "b\na\n") for f in files]))
+        commands = []
+        for extra in [[], ["--pattern-rules"]]:
+            monkOutput(["@Monkfile", "--files"] + files
+                       + ["-o", "monk.makefile"] + extra)
+            with open("monk.makefile") as f:
+                written = f.read()
+            p = subprocess.Popen(["make", "-n", "-B", "-f", "monk.makefile",
+                                  "all"], stdout=subprocess.PIPE)
+            (out, err) = p.communicate()
+            assert p.returncode == 0, written
+            #$(dir ...) leaves a slash on the end of directories.
+            commands.append(sorted([re.sub("/$", "", line) for line
+                                    in out.decode("utf-8").splitlines()]))
+        assert "out/%.sorted: out/%.txt" in written, written
+        assert commands[0] == commands[1], commands
+    scratch(test)
+    print("pattern rules ok")
+
+def testNinja():
+    """A build.ninja builds everything, rules with several outputs
+    included, then has nothing to do until a file is added to a scanned
+    directory, when it regenerates itself and builds just the new one."""
+    def ninja():
+        p = subprocess.Popen(["ninja"], stdout=subprocess.PIPE)
+        out = p.communicate()[0].decode("utf-8")
+        assert p.returncode == 0, out
+        return [re.sub(r"^\[[0-9/]*\] ", "", line) for line in out.splitlines()]
+    def test():
+        writeFiles({"data/a.txt": "a\n", "data/sub/b.txt": "b\n",
+                    "Monkfile": "--command cp --match --input "
+                    "'data/(.*)\\.txt$' --output 'out/{0}.txt'\n"
+                    "--command tee --output 'out/{0}.copy' "
+                    "< --input --match 'out/(.*)\\.txt$' "
+                    "> --output 'out/{0}.tee'\n"})
+        monkOutput(["@Monkfile", "--scan", ".", "--backend", "ninja",
+                    "-o", "build.ninja"])
+        assert sorted(ninja()) == ["cp data/a.txt out/a.txt",
+                                   "cp data/sub/b.txt out/sub/b.txt",
+                                   "tee out/a.copy < out/a.txt > out/a.tee",
+                                   "tee out/sub/b.copy < out/sub/b.txt > "
+                                   "out/sub/b.tee"]
+        assert ninja() == ["ninja: no work to do."]
+        writeFiles({"data/sub/c.txt": "c\n"})
+        assert ninja() == ["regenerating build.ninja",
+                           "cp data/sub/c.txt out/sub/c.txt",
+                           "tee out/sub/c.copy < out/sub/c.txt > out/sub/c.tee"]
+        assert open("out/sub/c.copy").read() == "c\n"
+        assert not os.path.exists("tags")
+    if not [d for d in os.environ.get("PATH", "").split(os.pathsep)
+            if os.path.isfile(os.path.join(d, "ninja"))]:
+        print("ninja not found, skipped")
+        return
+    scratch(test)
+    print("ninja ok")
+
+def make(*args):
+    """What make prints, run quietly in the current directory."""
+    p = subprocess.Popen(["make", "-s"] + list(args), stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE)
+    (out, err) = p.communicate()
+    assert p.returncode == 0, err
+    return out.decode("utf-8").splitlines()
+
+def testHashed():
+    """With --hashed, a touched input doesn't make anything run, and a
+    rule that rebuilds its output unchanged doesn't make the rules
+    downstream of it run."""
+    def test():
+        writeFiles({"data/a.txt": "b\na\n",
+                    "Monkfile": "--command sort --match --input "
+                    "'data/(.*)\\.txt$' > --output --mkdir 'out/{0}.sorted' "
+                    "&& echo sorted {0}\n"
+                    "--command wc %-l < --input --match 'out/(.*)\\.sorted$' "
+                    "> --output 'out/{0}.count' && echo counted {0}\n"})
+        monkOutput(["@Monkfile", "--files", "data/a.txt", "--hashed",
+                    "-o", "monk.makefile"])
+        args = ["-f", "monk.makefile", "out/a.count"]
+        assert make(*args) == ["sorted a", "counted a"]
+        t = time.time() + 10
+        os.utime("data/a.txt", (t, t))
+        assert make(*args) == []
+        writeFiles({"data/a.txt": "a\nb\n"})
+        os.utime("data/a.txt", (t + 10, t + 10))
+        assert make(*args) == ["sorted a"]
+        writeFiles({"data/a.txt": "a\nb\nc\n"})
+        os.utime("data/a.txt", (t + 20, t + 20))
+        assert make(*args) == ["sorted a", "counted a"]
+        assert open("out/a.count").read().strip() == "3"
+    scratch(test)
+    print("hashed ok")
+
+def testArtifacts():
+    """Checkouts sharing an artifact cache run a command on the same
+    inputs once; the others get writable copies of its outputs, which
+    can be changed without changing what the cache holds."""
+    def test():
+        for checkout in ["one", "two", "three"]:
+            writeFiles({checkout + "/data/a.txt": "b\na\n",
+                        checkout + "/Monkfile": "--command sort --match "
+                        "--input 'data/(.*)\\.txt$' "
+                        "> --output --mkdir 'out/{0}.sorted' "
+                        "&& echo sorted {0}\n"})
+            os.chdir(checkout)
+            monkOutput(["@Monkfile", "--files", "data/a.txt",
+                        "--artifacts", "../cache", "-o", "monk.makefile"])
+            ran = make("-f", "monk.makefile")
+            assert ran == (["sorted a"] if checkout == "one" else []), ran
+            assert open("out/a.sorted").read() == "a\nb\n", checkout
+            assert os.stat("out/a.sorted").st_nlink == 1
+            with open("out/a.sorted", 'a') as f:
+                f.write("changed\n")
+            os.chdir(os.pardir)
+        stats = monkOutput(["artifacts", "cache"]).splitlines()
+        assert "hits: 2" in stats and "misses: 1" in stats, stats
+    scratch(test)
+    print("artifacts ok")
+
+def testMatchIndex():
+    """Matching through the MatchIndex finds the same commands, with the
+    same groups, as trying every command in turn."""
+    patternSets = [
+        [r"data/(.*)\.txt$", r"data/(.*)\.csv$", r"data/(.*)\.txt",
+         r"data/([^/]*)/(.*)\.txt$", r"data/x?(.*)\.txt$",
+         r"(.*)\.txt$", r"(?i)DATA/(.*)\.TXT$", r"data/(a|b)\.txt",
+         r"src/(.*)\.[rR]$", r"src/(.*)\.R$", r"src/(.*)\.R\Z",
+         r"(src|data)/(.*)\.txt$", r"(.)\1\.txt", r"[sd]ata/(.*)",
+         r"data/(?P<name>.*)\.txt$", r"data\.(.*)$", r".*",
+         r"src/(?:.*/)?(.*)\.m$", r"data/(.*)\.txt\.gz$"],
+        #flags in one pattern mustn't spread to the others.
+        [r"(?x) (\w+) \. dat$", r"(\w+) (\w+)$", r"(\w+)-(\w+)$"]]
+    names = ["data/a.txt", "data/b.txt", "DATA/A.TXT", "data/a.txt.gz",
+             "data/sub/c.txt", "data/xy.txt", "src/f.R", "src/f.r",
+             "src/f.R\n", "src/a/b/g.m", "aa.txt", "ab.txt", "sata/q",
+             "data.csv", "data/a.csv", "", "data", "src/", "other/a.txt",
+             "data/a.txt\n", "ab cd", "ab-cd", "ab.dat"]
+    for patterns in patternSets:
+        commands = [Command([UnmatchedWord(p, match=True)]) for p in patterns]
+        index = MatchIndex(commands)
+        for name in names:
+            everything = [(n, c.matchGroups(name))
+                          for (n, c) in enumerate(commands)
+                          if c.matchGroups(name) is not None]
+            assert matchFile(index, commands, name) == everything, name
+    print("match index ok")
+
+##The tests below run monk in a scratch directory, each run in a process
+##of its own.
+
+monkScript = os.path.abspath(__file__)
+
+def scratch(test):
+    """Run a function in a fresh temporary directory."""
+    here = os.getcwd()
+    directory = tempfile.mkdtemp(prefix="monktest.")
+    os.chdir(directory)
+    try:
+        test()
+    finally:
+        os.chdir(here)
+        shutil.rmtree(directory)
+
+def writeFiles(files):
+    for (path, text) in files.items():
+        if os.path.dirname(path) and not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(text)
+
+def monkOutput(args):
+    """What monk prints on stdout, run with these arguments."""
+    p = subprocess.Popen([sys.executable, monkScript] + args,
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    (out, err) = p.communicate()
+    assert p.returncode == 0, err
+    return out.decode("utf-8")
+
+def testRun():
+    """--run runs only what's out of date, and rules with only phony
+    outputs every time, as make would."""
+    def test():
+        writeFiles({"a.txt": "a\n", "b.txt": "b\n",
+                    "Monkfile": "--command cp --match --input '(.*)\\.txt$' "
+                    "--output '{0}.out'\n"
+                    "--command --phony --output --invisible check "
+                    "--once cat --input --match '(.*)\\.out$'\n"})
+        run = ["@Monkfile", "--files", "a.txt", "b.txt", "--run"]
+        first = monkOutput(run).splitlines()
+        assert sorted(first) == ["a", "b", "cat a.out b.out",
+                                 "cp a.txt a.out", "cp b.txt b.out"], first
+        second = monkOutput(run).splitlines()
+        assert sorted(second) == ["a", "b", "cat a.out b.out"], second
+        t = time.time() + 10
+        os.utime("a.txt", (t, t))
+        third = monkOutput(run).splitlines()
+        assert sorted(third) == ["a", "b", "cat a.out b.out",
+                                 "cp a.txt a.out"], third
+    scratch(test)
+    print("run ok")
+
+def testCache():
+    """With --cache, the makefile comes out the same as a fresh run's as
+    base files come and go and a listing changes."""
+    def test():
+        writeFiles({"a.list": "out/s1_a.txt\n",
+                    "Monkfile": "--command cp --match --input "
+                    "'data/(.*)\\.txt$' --output 'out/{0}.txt'\n"
+                    "--command --once cat "
+                    "--match --input 'out/(s[0-9]+)_.*\\.txt$' "
+                    "--once --output 'sum/{0}.txt'\n"
+                    "--command gen --match --input 'data/s[0-9]+_(x).*' "
+                    "--output 'shared.{0}'\n"
+                    "--command check --output '{0}.check' "
+                    "--input --match --listing '(.*)\\.list$'\n"})
+        files = ["data/s1_a.txt", "data/s1_b.txt", "data/s2_a.txt",
+                 "data/s3_x1.txt", "data/s4_a.txt", "a.list"]
+        steps = [files, files[1:] + ["data/s5_a.txt"],
+                 ["data/s0_a.txt"] + files + ["data/s4_x2.txt"],
+                 files[:2] + files[3:], files]
+        for (n, step) in enumerate(steps):
+            if n == len(steps) - 1:
+                writeFiles({"a.list": "data/s6_a.txt\nout/s2_a.txt\n"})
+            args = ["@Monkfile", "--files"] + step
+            cached = monkOutput(args + ["--cache"])
+            assert cached == monkOutput(args), (n, cached)
+        #a graph kept in memory, as --watch keeps it, is brought up to
+        #date the same way.
+        ns = makeparser().parse_args(["@Monkfile"],
+                                     namespace=argparse.Namespace(commands=[]))
+        graphs = [RuleGraph(ns.commands, ns.maxdepth, ns.maxfiles)
+                  for n in range(2)]
+        graphs[0].update(files)
+        writeFiles({"a.list": "data/s7_a.txt\n"})
+        for graph in graphs:
+            graph.update(files)
+        (kept, fresh) = [[r.commandLine() for r in g.rules()] for g in graphs]
+        assert kept == fresh and "cp data/s7_a.txt out/s7_a.txt" in kept, kept
+    scratch(test)
+    print("cache ok")
+
+def testInterpreter():
+    """Pass output to the interpreter server's forwarding in awkward
+    pieces, and check that the client gets it once, with the status, and
+    nothing from before or after the job."""
+    class Client(object):
+        def __init__(self):
+            self.messages = []
+        def send(self, message):
+            self.messages.append(message)
+        def close(self):
+            pass
+    def run(job, chunks):
+        (start, sentinel) = [toBytes(m) for m in jobMarkers(job)]
+        chunks = [(stream, data.replace(b"START", start).replace(b"DONE", sentinel))
+                  for (stream, data) in chunks]
+        client = Client()
+        w.start(client, "", job)
+        done = [w.forward(stream, data) for (stream, data) in chunks]
+        w.finish(w.status)
+        received = dict([(s, "".join([m[s] for m in client.messages
+                                      if m.has_key(s)]))
+                         for s in ["out", "err"]])
+        return (done, received, client.messages[-1])
+    w = Interpreter(["cat"])
+    try:
+        first = run("1", [("out", b"START\nhello "), ("err", b"monk-job-sta"),
+                          ("err", b"rt-1\noops\nmonk-"),
+                          ("out", b"world\nDONE"), ("err", b"job-done-1\n"),
+                          ("out", b" 3"), ("out", b" \n>> "), ("out", b">> ")])
+        #the prompts after the first job come before the second's marker.
+        second = run("2", [("out", b">> >> START\nagain\nDONE 0\n"),
+                           ("err", b"START\nDONE\n")])
+    finally:
+        w.stop()
+    assert first == ([False] * 6 + [True, False],
+                     {"out": "hello world\n", "err": "oops\n"},
+                     {"status": 3}), first
+    assert second == ([False, True], {"out": "again\n", "err": ""},
+                      {"status": 0}), second
+    print("interpreter forwarding ok")
+
 def goFromString(str):
     args = shlex.split(str, comments=True)
     parser = makeparser()
@@ -665,17 +4671,49 @@ def goFromString(str):
 
 def go(**kwargs):
     kwargs.pop("")
-    rules = generateRules(**kwargs)
-    rules_dict = dict()
-    for r in rules:
-        r.setTagged()
-        for o in r.products():
-            rules_dict[o] = r;
-    [print(i.makeRule(rules_dict, **kwargs)) for i in rules]
+    report = kwargs.pop("profile", None)
+    profile = None
+    if report is not None:
+        profile = Profile(kwargs["commands"])
+    if (kwargs.get("worker") or kwargs.get("local_workers")) and not kwargs.get("run"):
+        raise Exception("--worker and --local-workers need --run")
+    if kwargs.get("watch"):
+        sys.exit(watchRules(**kwargs))
+    if kwargs.get("run"):
+        status = runRules(profile=profile, **kwargs)
+        if profile is not None:
+            profile.write(report)
+        sys.exit(status)
+    started = time.time()
+    finder = FileFinder(kwargs["commands"], kwargs.get("ignore") or [],
+                        kwargs.get("tagdir", "tags"))
+    rules = generateRules(profile=profile, finder=finder, **kwargs)
+    goals = None
+    if kwargs.get("goal"):
+        (rules, goals) = goalRules(rules, kwargs["goal"])
+    rules = batchRules(rules, kwargs["commands"], kwargs.get("tagdir", "tags"))
+    if kwargs.get("report"):
+        status = timingReport(rules, kwargs["commands"], kwargs["report"],
+                              sys.stdout)
+        if status:
+            sys.exit(status)
+        return
+    generated = time.time()
+    generatedPeak = maxrssKB()
+    emitter = makeEmitter(rules, goals, finder, **kwargs)
+    emitOutput(emitter, finder=finder, **kwargs)
+    writeManifests(rules)
+    if kwargs.get("verbose"):
+        print(listingCache.stats(), file=sys.stderr)
+    if profile is not None:
+        profile.phase("generate", generated - started, generatedPeak)
+        profile.phase("emit", time.time() - generated, maxrssKB())
+        profile.write(report)
 
 if __name__ == "__main__":
-    parser = makeparser()
-    ns = parser.parse_args(namespace=argparse.Namespace(commands=[], files=[]))
+    if len(sys.argv) > 1 and helpers.has_key(sys.argv[1]):
+        sys.exit(helpers[sys.argv[1]](sys.argv[2:]))
+    ns = parseArgs(sys.argv[1:])
     go(**ns.__dict__)
 
 